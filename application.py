@@ -1,12 +1,28 @@
+import hashlib
+import hmac
 import logging
+import time
 
-from flask import Flask,jsonify,request
+from flask import Flask,Response,abort,jsonify,request
 
-from game import GameState
+from game import GameState,SlackResponse,VersionConflict
+from deferred import DeferredResponder
+from coalesce import Coalescer
+from grammar import Command,tokenize
+from images import HandImages
+from ratelimit import RateLimiter
 import commands
+import metrics
+import storage
 
 app = Flask(__name__)
 app.config.from_envvar('FISLACKO_SETTINGS')
+storage.configure(app.config)
+storage.preload()
+commands.DICE_IMAGE_URL = app.config.get('DICE_IMAGE_URL')
+hand_images = HandImages()
+if commands.DICE_IMAGE_URL:
+    hand_images.load()
 
 COMMAND_MAPPINGS = {'reset': commands.reset_game,
                     'register': commands.register,
@@ -17,50 +33,235 @@ COMMAND_MAPPINGS = {'reset': commands.reset_game,
                     'give': commands.give,
                     'pool': commands.pool,
                     'roll': commands.roll,
+                    'odds': commands.odds,
                     'spend': commands.spend}
-                    
+
+# Commands that work from the event log without loading the game
+LOG_COMMAND_MAPPINGS = {'history': commands.history,
+                        'undo': commands.undo}
+
+COMMAND_NAMES = frozenset(COMMAND_MAPPINGS) | frozenset(LOG_COMMAND_MAPPINGS)
+
+# How many times a command is re-run against fresh state when another command saved first
+SAVE_ATTEMPTS = 10
+
+# Commands a second each workspace may run in this worker, with bursts of up to TEAM_RATE_BURST
+team_limiter = None
+if app.config.get('TEAM_RATE_LIMIT'):
+    team_limiter = RateLimiter(app.config['TEAM_RATE_LIMIT'],app.config.get('TEAM_RATE_BURST',20))
+# The same for each channel
+channel_limiter = None
+if app.config.get('CHANNEL_RATE_LIMIT'):
+    channel_limiter = RateLimiter(app.config['CHANNEL_RATE_LIMIT'],app.config.get('CHANNEL_RATE_BURST',5))
+
+# Commands that only read the game when given no parameters. Identical ones running at the
+# same time for the same game share one load and one response.
+READ_ONLY_COMMANDS = frozenset(['status','pool','setup'])
+coalescer = Coalescer()
+
+# Deferred replies are only posted to response_urls starting with one of these, so a forged
+# request cannot make the server post to other (e.g. internal) addresses
+RESPONSE_URL_PREFIXES = tuple(app.config.get('RESPONSE_URL_PREFIXES',('https://hooks.slack.com/',)))
+
+def is_slack_url(response_url):
+    return bool(response_url) and response_url.startswith(RESPONSE_URL_PREFIXES)
+
+# How old a signed request may be, in seconds, before it is refused as a possible replay
+SIGNATURE_MAX_AGE = 300
+
+def signature(secret,timestamp,body):
+    """ The X-Slack-Signature Slack sends with a request body, signed with the app's secret """
+    return 'v0=' + hmac.new(secret,'v0:%s:%s' % (timestamp,body),hashlib.sha256).hexdigest()
+
+def verify_signature(secret,timestamp,body,signed,now=None):
+    try:
+        if abs((now or time.time())-int(timestamp)) > SIGNATURE_MAX_AGE:
+            return False
+    except (TypeError,ValueError):
+        return False
+    return hmac.compare_digest(signature(secret,timestamp,body),str(signed or ''))
 
 @app.route('/fiasco/',methods=['POST','GET'])
 def router():
-    data = request.form.get('text','').split(' ')
+    secret = app.config.get('SLACK_SIGNING_SECRET')
+    if secret and not verify_signature(secret,request.headers.get('X-Slack-Request-Timestamp'),
+                                       request.get_data(),request.headers.get('X-Slack-Signature')):
+        abort(403)
+    data = tokenize(request.form.get('text',''))
     userid = request.form.get('user_id')
     username = request.form.get('user_name')
-    game_id = request.form.get('channel_id')
+    channel_id = request.form.get('channel_id')
+    team_id = request.form.get('team_id')
+    response_url = request.form.get('response_url')
 
+    if team_limiter is not None and not team_limiter.allow(team_id):
+        metrics.RATE_LIMITED.inc(limit='team')
+        return jsonify(SlackResponse('This workspace is sending too many commands. Try again in a moment.').to_json())
+    if channel_limiter is not None and not channel_limiter.allow(storage.game_key(team_id,channel_id)):
+        metrics.RATE_LIMITED.inc(limit='channel')
+        return jsonify(SlackResponse('This channel is sending too many commands. Try again in a moment.').to_json())
+    if app.config.get('DEFERRED_RESPONSES') and is_slack_url(response_url):
+        responder.submit(response_url,channel_id,data,userid,username,team_id)
+        return jsonify(SlackResponse('Working on it...').to_json())
     try:   
-        return jsonify(route(game_id,data,userid,username))
+        return jsonify(route(channel_id,data,userid,username,team_id))
     except Exception, e:
         logging.error(e)
         return jsonify({'text': 'Whoops! Error.'})
 
+# Commands parsed from each recent text, so the common ones ("status", "take w5") are only
+# parsed once. Commands are shared between requests, so handlers must not change their
+# params. Cleared when full, which is cheaper than keeping LRU order.
+PARSE_CACHE_SIZE = 1024
+_parsed = {}
+
+def parse_steps(data):
+    """ Split the words of a command into Commands separated by ;. A ; only starts a new
+    command when a command name follows it, so setup and register text can contain them. """
+    text = ' '.join(data)
+    steps = _parsed.get(text)
+    if steps is None:
+        if ';' in text:
+            texts = []
+            for piece in text.split(';'):
+                words = tokenize(piece)
+                if texts and words and words[0].lower() not in COMMAND_NAMES:
+                    texts[-1] += ';' + piece
+                elif words:
+                    texts.append(piece)
+            steps = [Command(tokenize(step)) for step in texts]
+        else:
+            words = tokenize(text)
+            steps = [Command(words)] if words else []
+        if len(_parsed) >= PARSE_CACHE_SIZE:
+            _parsed.clear()
+        _parsed[text] = steps
+    return steps
+
+def run_steps(game,steps,userid,username):
+    """ Run each step against the same game. Returns the first failed response, or one
+    response combining every step's text """
+    responses = []
+    for step in steps:
+        response = COMMAND_MAPPINGS[step.name](game,step.params,userid,username)
+        if response.failed:
+            if len(steps) > 1:
+                response.text = u'Nothing was done because "%s" failed: %s' % (' '.join([step.name] + step.params),response.text)
+            return response
+        responses.append(response)
+    if len(responses) == 1:
+        return responses[0]
+    return SlackResponse(u'\n'.join(r.text for r in responses),
+                         any(r.response_type == 'in_channel' for r in responses))
+
+def run_game_command(backend,game_id,steps,data,userid,username):
+    """ Load the game, run steps and save, again from the top if another command saved first """
+    timer = metrics.CommandTimer(game_id,steps[0].name if len(steps) == 1 else 'batch')
+    try:
+        for attempt in range(SAVE_ATTEMPTS):
+            with timer.phase('load'):
+                game_state = GameState(backend=backend)
+                game_state.load(game_id)
+            with timer.phase('command'):
+                response = run_steps(commands.Game(game_state),
+                            steps,userid,username)
+            if response.failed and len(steps) > 1:
+                return response.to_json() # Don't save any of the steps
+            try:
+                with timer.phase('save'):
+                    game_state.save(game_id,{'command': ' '.join(data).strip(), 'user': username,
+                                             'user_id': userid, 'time': int(time.time())})
+            except VersionConflict:
+                timer.conflicts += 1
+                continue
+            timer.document = game_state.data
+            return response.to_json()
+        raise VersionConflict('Gave up on %s after %d attempts' % (game_id,SAVE_ATTEMPTS))
+    except Exception:
+        timer.error = True
+        raise
+    finally:
+        timer.finish()
+
 # Broken out to assist in testing
-def route(game_id,data,userid,username):
-    command = None
-    params = []
-    if data:
-        command = COMMAND_MAPPINGS.get(data[0].lower())
-        if len(data) > 1:
-            params = data[1:]
-    if command:
-        game_state = GameState()
-        game_state.load(game_id)
+def route(channel_id,data,userid,username,team_id=None):
+    game_id = storage.game_key(team_id,channel_id)
+    backend = storage.get_backend(team_id)
+    steps = parse_steps(data)
+    if len(steps) == 1 and steps[0].name in LOG_COMMAND_MAPPINGS:
+        timer = metrics.CommandTimer(game_id,steps[0].name)
         try:
-            return command(commands.Game(game_state),
-                        params,userid,username).to_json()
+            with timer.phase('load'):
+                if backend.load(game_id) is None: # Its log is archived or unkeyed with it
+                    storage.restore(backend,game_id) or storage.restore_unkeyed(backend,game_id)
+            with timer.phase('command'):
+                return LOG_COMMAND_MAPPINGS[steps[0].name](backend,game_id,
+                            steps[0].params,userid,username).to_json()
+        except Exception:
+            timer.error = True
+            raise
         finally:
-            game_state.save(game_id)
+            timer.finish()
+    if steps and all(step.name in COMMAND_MAPPINGS for step in steps):
+        step = steps[0]
+        if len(steps) == 1 and step.name in READ_ONLY_COMMANDS and not step.params:
+            response,shared = coalescer.run((game_id,step.name),lambda: run_game_command(
+                backend,game_id,steps,data,userid,username))
+            if shared:
+                metrics.COALESCED.inc(command=step.name)
+            return dict(response)
+        return run_game_command(backend,game_id,steps,data,userid,username)
     return {'text': u"""Usage: /slack command, where commands are:
 reset [confirm]:  reset the game if "confirm" is passed as the parameter
 setup [add|remove]: display the current setup. If add is the parameter, add rest of text as setup text. If remove, remove the nth item.
-pool [reroll|setup]: show the current dice pool. if setup passed as a parameter, setup the initial pool. if reroll passed in, reroll all dice in the pool.
+pool [reset|reroll] [all]: show the current dice pool. if reset passed as a parameter, setup the initial pool. if reroll passed in, reroll all dice in the pool. add all to do it for every table in the channel too.
 register [name]: register your player name with the game
 unregister [name]: unregister yourself or the specified user
 status: output current status to channel
 take [color number]: take a die from the pool
 give [color number] [user]: give a die to another player. use "pool" as player name to return to the pool. 
 roll: roll all your dice and give the aggregate score
-spend: spend one your dice (so you no longer have it)"""}
+odds [white black]: chances of your dice (or that many white and black dice) rolling white, black or zero
+spend: spend one your dice (so you no longer have it)
+history [count]: show the last changes made to the game
+undo: undo the last change made to the game (repeat to undo earlier ones)
+Several commands can be run together by separating them with ; e.g. take w5; roll
+(a ; not followed by a command is kept as text, e.g. setup add Lies; old debts)
+If any of them fails, none of them are applied."""}
+
+@app.route('/dice/<spec>.png',methods=['GET'])
+def dice_image(spec):
+    """ A picture of some dice, for replies to workspaces without the d6 emoji """
+    if not commands.DICE_IMAGE_URL:
+        abort(404) # Images are off
+    try:
+        etag,png = hand_images.render(spec)
+    except ValueError:
+        abort(404)
+    response = Response(png,mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
+
+@app.route('/metrics',methods=['GET'])
+def metrics_view():
+    return Response(metrics.render(),mimetype='text/plain; version=0.0.4')
+
+responder = DeferredResponder(route,app.config.get('DEFERRED_WORKERS',2))
+
+def cache_stat(name):
+    stats = getattr(storage.get_backend(),'stats',None)
+    return stats and stats()[name]
 
+metrics.Gauge('fislacko_deferred_queue_depth','Commands waiting for a background worker',
+              lambda: responder.stats()['queue_depth'])
+metrics.Gauge('fislacko_deferred_delivered','Deferred responses delivered',lambda: responder.stats()['delivered'])
+metrics.Gauge('fislacko_deferred_failed','Deferred responses that could not be delivered',lambda: responder.stats()['failed'])
+metrics.Gauge('fislacko_deferred_latency_p99_seconds','p99 time from acknowledgement to delivery',
+              lambda: responder.stats().get('latency_p99'))
+for stat in ('size','hits','misses','evictions','invalidations'):
+    metrics.Gauge('fislacko_cache_%s' % stat,'Game cache %s' % stat,lambda stat=stat: cache_stat(stat))
 
 if __name__ == '__main__':
     app.run(debug=True,host='104.236.212.18')
@@ -0,0 +1,311 @@
+""" Benchmarks for the Fiasco/Slack web service.
+
+Usage:
+  python benchmarks.py storage [-n iterations]
+      Load/save latency with a client per request vs the shared client. Needs a mongod.
+  python benchmarks.py http URL [-n requests] [-c concurrency]
+      Concurrent throughput of a running server, e.g. to compare gunicorn.sh against
+      gunicorn-gevent.sh.
+  python benchmarks.py commands [-p players] [-n rounds] [-s setup size] [-b backend]
+      Drives game sessions through application.route() against a memory or sqlite store
+      and reports the cost of each command.
+  python benchmarks.py pool [-t tables] [-p players per table] [-n repeats]
+      Resetting and rerolling the pools of every table in a channel: a Die at a time and a
+      save per table, as before, vs rolled counts and one save for the channel.
+  python benchmarks.py parse [-n repeats]
+      Tokenizing and parsing a corpus of command strings, old way vs grammar.py, with
+      and without the cache of parsed commands.
+  python benchmarks.py startup [-n runs] [--max-import-ms N] [--max-first-response-ms N]
+      Import time and time to first response of application.app in fresh interpreters.
+      Exits with status 1 if the median is over either limit, for use in CI.
+"""
+import argparse
+import collections
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import storage
+from game import Die,Game,GameState
+
+TEST_SETTINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)),'test_settings.cfg')
+
+def percentile(timings,pct):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered)-1,int(len(ordered)*pct/100.0))]
+
+def report(name,timings):
+    print '%-24s n=%-6d mean %7.2fms  p50 %7.2fms  p99 %7.2fms' % (name,len(timings),
+        1000*sum(timings)/len(timings),1000*percentile(timings,50),1000*percentile(timings,99))
+
+def unpooled_request(game_id):
+    """ What every command used to cost: a new client for load and another for save """
+    import pymongo
+    client = pymongo.MongoClient(storage.setting('MONGO_URI'))
+    data = client[storage.setting('MONGO_DATABASE')].games.find_one({'_id': game_id}) or {}
+    client.close()
+    client = pymongo.MongoClient(storage.setting('MONGO_URI'))
+    data['_id'] = game_id
+    client[storage.setting('MONGO_DATABASE')].games.replace_one({'_id': game_id},data,upsert=True)
+    client.close()
+
+def pooled_request(game_id):
+    game_state = GameState()
+    game_state.load(game_id)
+    game_state.put('','benchmark',time.time())
+    game_state.save(game_id)
+
+def bench_storage(iterations):
+    """ Per-request load/save latency with a client per call vs the shared client """
+    game_id = 'benchmark-storage'
+    for name,fn in (('client per request',unpooled_request),('shared client',pooled_request)):
+        timings = []
+        for i in range(iterations):
+            start = time.time()
+            fn(game_id)
+            timings.append(time.time()-start)
+        report(name,timings)
+    storage.games().delete_one({'_id': game_id})
+
+def bench_http(url,count,concurrency):
+    """ Post status commands to a running server from concurrency threads. Each thread uses
+    its own channel so the server is measured rather than save conflicts. """
+    from concurrent import futures
+    import requests
+    session = requests.Session()
+    session.mount(url,requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=concurrency))
+    def post(i):
+        start = time.time()
+        response = session.post(url,data={'text': 'status', 'user_id': 'U%d' % i,
+                                          'user_name': 'bench%d' % i,
+                                          'channel_id': 'BENCH%d' % (i % concurrency)})
+        response.raise_for_status()
+        return time.time()-start
+    start = time.time()
+    with futures.ThreadPoolExecutor(concurrency) as executor:
+        timings = list(executor.map(post,range(count)))
+    elapsed = time.time()-start
+    report('%d concurrent' % concurrency,timings)
+    print '%-24s %.1f requests/sec' % ('throughput',count/elapsed)
+
+def bench_commands(players,rounds,setup_size,backend):
+    """ Play a session: register players, add setup, reset the pool, then each round every
+    player takes, gives, rolls and spends dice and the channel checks status. Python 2 has
+    no tracemalloc, so objs/op is the net change in gc-tracked objects: objects a command
+    leaves allocated, which shows up leaks and growing caches. """
+    os.environ.setdefault('FISLACKO_SETTINGS',TEST_SETTINGS)
+    import application
+    settings = {'STORAGE_BACKEND': backend}
+    if backend == 'sqlite':
+        settings['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(),'benchmark.db')
+    storage.configure(settings)
+
+    timings = collections.defaultdict(list)
+    allocations = collections.defaultdict(int)
+    def run(name,text,i):
+        gc.disable()
+        objects = gc.get_count()[0]
+        start = time.time()
+        application.route('BENCH',text.split(' '),'U%d' % i,'player%d' % i)
+        timings[name].append(time.time()-start)
+        allocations[name] += gc.get_count()[0]-objects
+        gc.enable()
+
+    faces = ['%s%d' % (color,number) for color in 'wb' for number in range(1,7)]
+    for i in range(players):
+        run('register','register Player %d' % i,i)
+    for i in range(setup_size):
+        run('setup add','setup add Relationship %d: old friends from the bowling league' % i,0)
+    run('pool reset','pool reset',0)
+    for round in range(rounds):
+        for i in range(players):
+            run('take','take %s' % random.choice(faces),i)
+            run('give','give %s player%d' % (random.choice(faces),random.randrange(players)),i)
+            run('roll','roll',i)
+            run('spend','spend %s' % random.choice(faces),i)
+        run('status','status',0)
+        run('pool','pool',0)
+
+    print '%-12s %7s %10s %9s %9s %9s' % ('command','n','ops/sec','p50 ms','p99 ms','objs/op')
+    for name,times in sorted(timings.items()):
+        print '%-12s %7d %10.0f %9.3f %9.3f %9.1f' % (name,len(times),len(times)/sum(times),
+            1000*percentile(times,50),1000*percentile(times,99),float(allocations[name])/len(times))
+
+def pool_channel(tables,players):
+    """ A channel game with players at each of tables tables, saved to a memory backend """
+    backend = storage.MemoryBackend()
+    game_state = GameState(backend=backend)
+    for table in range(tables):
+        game_state.put('tables','t%d' % table,{})
+        game = Game(game_state,'tables/t%d' % table)
+        for i in range(players):
+            game.set_user('u%d' % i,'player%d' % i,'Player %d' % i)
+    game_state.save('POOL')
+    return backend
+
+def pool_old(backend):
+    """ How a reset then reroll of every table cost before: a command (and save) per table,
+    dice made one Die at a time """
+    for action in ('reset','reroll'):
+        game_state = GameState(backend=backend)
+        game_state.load('POOL')
+        for name,game in Game(game_state).tables():
+            game_state = GameState(backend=backend)
+            game_state.load('POOL')
+            game = Game(game_state,game.path)
+            if action == 'reset':
+                dice = []
+                for color in ('black','white'):
+                    for i in range(len(game.users)*2):
+                        dice.append(Die(color=color,number=random.randint(1,6)))
+            else:
+                dice = [Die(color=die.color,number=random.randint(1,6)) for die in game.dice]
+            game.dice = dice
+            game_state.save('POOL')
+
+def pool_new(backend):
+    import commands
+    from grammar import Params
+    for action in ('reset','reroll'):
+        game_state = GameState(backend=backend)
+        game_state.load('POOL')
+        commands.pool(Game(game_state),Params([action,'all']),'u0','player0')
+        game_state.save('POOL')
+
+def bench_pool(tables,players,repeats):
+    """ Reset then reroll every table's pool, repeats times """
+    print '%d tables of %d players, %d dice' % (tables,players,tables*players*4)
+    for name,fn in (('a die and save at a time',pool_old),('batched, one save',pool_new)):
+        backend = pool_channel(tables,players)
+        writes = []
+        update = backend.update
+        backend.update = lambda *args: writes.append(1) or update(*args)
+        timings = []
+        for i in range(repeats):
+            start = time.time()
+            fn(backend)
+            timings.append(time.time()-start)
+        report(name,timings)
+        print '%-24s %d per reset + reroll' % ('writes',len(writes)/repeats)
+
+PARSE_CORPUS = ['take w5', 'take white 5', 'take  b1', 'give w5 @bob', 'give black 3 pool',
+                'give b2 alice', 'spend w1', 'spend black  6', 'roll', 'status', 'pool',
+                'pool reset', 'register Detective Sam Hardy', 'unregister @bob',
+                'setup add Relationship: old friends from the bowling league', 'odds 3 2',
+                'take w5; take b2; roll', 'history 5', 'undo', 'reset confirm']
+
+def parse_old(text,Die,InvalidDie):
+    """ How router and the handlers parsed commands before grammar.py """
+    data = text.split(' ')
+    name,params = data[0].lower(),data[1:]
+    try:
+        if name in ('take','spend'):
+            return Die(params=params)
+        if name == 'give':
+            return Die(params=params[0:-1]),params[-1].replace('@','')
+    except InvalidDie:
+        return None
+    return ' '.join(params)
+
+def parse_new(text,parse_steps):
+    """ parse_steps, and whatever the handler reads from each step's Params """
+    steps = parse_steps(text.split())
+    for step in steps:
+        if step.name in ('take','spend'):
+            step.params.die
+        elif step.name == 'give':
+            step.params.target_die,step.params.target
+    return steps
+
+def parse_uncached(text,parse_steps,parsed):
+    """ parse_new for text never seen before """
+    parsed.clear()
+    return parse_new(text,parse_steps)
+
+def bench_parse(repeats):
+    """ Parse every command in PARSE_CORPUS, repeats times """
+    os.environ.setdefault('FISLACKO_SETTINGS',TEST_SETTINGS)
+    import application
+    from game import Die,InvalidDie
+    for name,fn,args in (('split + Die regex',parse_old,(Die,InvalidDie)),
+                         ('grammar',parse_new,(application.parse_steps,)),
+                         ('grammar, uncached',parse_uncached,(application.parse_steps,application._parsed))):
+        seconds = min(timeit.repeat(lambda: [fn(text,*args) for text in PARSE_CORPUS],number=repeats,repeat=5))
+        print '%-24s %7.2fus per command' % (name,1e6*seconds/(repeats*len(PARSE_CORPUS)))
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.time()
+import application
+imported = time.time()
+application.app.test_client().post('/fiasco/', data={'text': 'status', 'channel_id': 'STARTUP',
+                                                      'user_id': 'U1', 'user_name': 'startup'})
+print json.dumps({'import': imported - start, 'first_response': time.time() - start,
+                  'modules': sorted(set(m.split('.')[0] for m in sys.modules))})
+"""
+
+def bench_startup(runs,max_import_ms,max_first_response_ms):
+    """ Start runs fresh interpreters as a worker would and time importing the app and
+    answering its first command. Returns False if a limit was exceeded. """
+    env = dict(os.environ)
+    env.setdefault('FISLACKO_SETTINGS',TEST_SETTINGS)
+    results = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable,'-c',STARTUP_SCRIPT],env=env,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append(json.loads(output.splitlines()[-1]))
+    report('import',[r['import'] for r in results])
+    report('first response',[r['first_response'] for r in results])
+    heavy = [m for m in ('pymongo','requests','sqlite3') if m in results[0]['modules']]
+    print '%-24s %s' % ('heavy modules loaded',', '.join(heavy) or 'none')
+    ok = True
+    for name,limit in (('import',max_import_ms),('first_response',max_first_response_ms)):
+        median = 1000*percentile([r[name] for r in results],50)
+        if limit and median > limit:
+            print 'FAIL: median %s %.1fms is over the %.1fms limit' % (name,median,limit)
+            ok = False
+    return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the fislacko service')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    storage_parser = subparsers.add_parser('storage')
+    storage_parser.add_argument('-n','--iterations',type=int,default=500)
+    http_parser = subparsers.add_parser('http')
+    http_parser.add_argument('url')
+    http_parser.add_argument('-n','--requests',type=int,default=2000)
+    http_parser.add_argument('-c','--concurrency',type=int,default=50)
+    commands_parser = subparsers.add_parser('commands')
+    commands_parser.add_argument('-p','--players',type=int,default=5)
+    commands_parser.add_argument('-n','--rounds',type=int,default=200)
+    commands_parser.add_argument('-s','--setup',type=int,default=20)
+    commands_parser.add_argument('-b','--backend',choices=('memory','sqlite'),default='memory')
+    pool_parser = subparsers.add_parser('pool')
+    pool_parser.add_argument('-t','--tables',type=int,default=20)
+    pool_parser.add_argument('-p','--players',type=int,default=5)
+    pool_parser.add_argument('-n','--repeats',type=int,default=50)
+    parse_parser = subparsers.add_parser('parse')
+    parse_parser.add_argument('-n','--repeats',type=int,default=2000)
+    startup_parser = subparsers.add_parser('startup')
+    startup_parser.add_argument('-n','--runs',type=int,default=5)
+    startup_parser.add_argument('--max-import-ms',type=float)
+    startup_parser.add_argument('--max-first-response-ms',type=float)
+    args = parser.parse_args()
+    if args.benchmark == 'storage':
+        bench_storage(args.iterations)
+    elif args.benchmark == 'http':
+        bench_http(args.url,args.requests,args.concurrency)
+    elif args.benchmark == 'commands':
+        bench_commands(args.players,args.rounds,args.setup,args.backend)
+    elif args.benchmark == 'pool':
+        bench_pool(args.tables,args.players,args.repeats)
+    elif args.benchmark == 'parse':
+        bench_parse(args.repeats)
+    elif not bench_startup(args.runs,args.max_import_ms,args.max_first_response_ms):
+        sys.exit(1)
@@ -0,0 +1,44 @@
+""" Lets identical requests that arrive together share one piece of work.
+"""
+import threading
+
+class _Call(object):
+    __slots__ = ('done','result','error','waiters')
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+        self.waiters = 0
+
+class Coalescer(object):
+    """ While fn is running for a key, other run() calls with that key wait for it and get
+    the same result (or exception) instead of running fn again. Once it finishes the next
+    call runs fn afresh, so a shared result is never older than the start of the call
+    it was shared from. """
+    def __init__(self):
+        self.calls = {} # key -> _Call in progress
+        self.lock = threading.Lock()
+
+    def run(self,key,fn):
+        """ Return (result of fn, whether it was shared with a call already in progress) """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result,True
+        try:
+            call.result = fn()
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result,False
@@ -1,10 +1,27 @@
 """ Contains the commands for the Fiasco/Slack web service
 """
-import random
 import re
 import logging
+import time
 
-from game import SlackResponse,InvalidDie,Die,Game
+from game import SlackResponse,Die,DicePool,Game,VersionConflict
+import images
+import odds as fiasco_odds
+
+# Where this app is served from, e.g. https://fiasco.example.com (the DICE_IMAGE_URL setting).
+# When set, status and pool replies come with one picture of all the dice they list, for
+# workspaces without the d6 emoji.
+DICE_IMAGE_URL = None
+
+def dice_image(hands):
+    """ URL of one image with a row for each hand (some dice), or None if images are off
+    or there are too many to show """
+    if (not DICE_IMAGE_URL or len(hands) > images.MAX_IMAGE_ROWS or sum(map(len,hands)) > images.MAX_IMAGE_DICE or
+            max(map(len,hands))*len(hands) > images.MAX_IMAGE_TILES):
+        return None
+    rows = [images.die_spec([d for d in hand if d.color == 'white'] + [d for d in hand if d.color == 'black'])
+            for hand in hands]
+    return '%s/dice/%s.png' % (DICE_IMAGE_URL.rstrip('/'),'_'.join(rows))
 
 def reset_game(game,params,user_id,user_name):
     """ Reset the game data """
@@ -12,7 +29,7 @@ def reset_game(game,params,user_id,user_name):
         game.clear()
         return SlackResponse('%s has reset the game.' % user_name)
     
-    return SlackResponse('To reset, pass in confirm as the parameter')   
+    return SlackResponse('To reset, pass in confirm as the parameter',failed=True)
 
 def setup(game,params,user_id,user_name):
     setup = game.setup
@@ -35,8 +52,8 @@ def register(game,params,user_id,user_name):
     # Take in name
     # Store name
     if not len(params):
-        return SlackResponse('Please provide the name you will go by.')
-    name = ' '.join(params)
+        return SlackResponse('Please provide the name you will go by.',failed=True)
+    name = params.text
     game.set_user(user_id,user_name,name)
     
     return SlackResponse('%s is now registered as %s' % (user_name,name),True)
@@ -44,7 +61,7 @@ def register(game,params,user_id,user_name):
 def unregister(game,params,user_id,user_name):
     """ Unregister the current user or a named user """
     if len(params):
-        unreg_name = ' '.join(params)
+        unreg_name = params.text
         unreg_id = game.get_user_id_for_slack_name(unreg_name)
     else:
         unreg_name = user_name
@@ -56,118 +73,196 @@ def unregister(game,params,user_id,user_name):
 def status(game,params,user_id,user_name):
     """ Send game status to channel """
     player_a = []
+    hands = []
     users = game.users or []
     if not users:
         player_a.append('No users registered')
     else:
         for uid,v in users.items():
             try:
-                player_a.append(u'%s (%s) %s' % (v['name'],v['slack_name'],game.format_dice_pool(game.get_user_dice(uid) or [])))
+                hand = list(game.get_user_pool(uid))
+                player_a.append(u'%s (%s) %s' % (v['name'],v['slack_name'],game.format_dice_pool(hand)))
+                hands.append(hand)
             except Exception, e:
                 logging.error(e)
+    pool = list(game.pool)
     return SlackResponse("""%s
 
 %s""" % (u"\n".join(player_a),
-               game.format_dice_pool(game.dice)),True)
+               game.format_dice_pool(pool)),True,image_url=dice_image(hands + [pool]))
 
 def take(game,params,user_id,user_name):
     """ Take a specific die from the pool """
     if len(params) < 1:
-        return SlackResponse("Usage: /fiasco take color number")
+        return SlackResponse("Usage: /fiasco take color number",failed=True)
     
     # Validate
-    try:
-        die = Die(params=params)
-    except InvalidDie:
-        return SlackResponse('Format is w5 or white 5 (or b1 or black 1')
+    die = params.die
+    if not die:
+        return SlackResponse('Format is w5 or white 5 (or b1 or black 1',failed=True)
     
     # Find die
-    user_dice = game.get_user_dice(user_id) or []
     if game.take_die_from_pool(die):
-        user_dice.append(die)
-        game.set_user_dice(user_id,user_dice)
+        game.give_die_to(die,user_id)
         return SlackResponse ("%s claimed %s.\nPool: %s" % (user_name, die.to_emoji(),game.format_dice_pool(game.dice) or 'Empty'),True)
 
-    return SlackResponse(u"Could not find a %s" % die)
+    return SlackResponse(u"Could not find a %s" % die,failed=True)
 
 def give(game,params,user_id,user_name):
     """ Give one of your dice to someone else """
     if len(params) < 2:
-        return SlackResponse("Usage: /fiasco die slack_name")
+        return SlackResponse("Usage: /fiasco die slack_name",failed=True)
     from_player = game.get_user(user_id)
     if not from_player:
-        return SlackResponse("You are not registered as a player. Please type /fiasco register your_game_name")
+        return SlackResponse("You are not registered as a player. Please type /fiasco register your_game_name",failed=True)
 
     # Load up our user and desired die
-    slack_name = params[-1].replace('@','') # Allow use of @
+    slack_name = params.target # Allow use of @
     if slack_name == 'pool':
         to_player_id = 'pool'
     else:
         to_player_id = game.get_user_id_for_slack_name(slack_name)
     if not to_player_id:
-        return SlackResponse('No player found with slack name "%s"' % slack_name)
-    try:
-        die = Die(params=params[0:-1])
-    except InvalidDie:
-        return SlackResponse('Format is w5 or white 5 (or b1 or black 1)')
+        return SlackResponse('No player found with slack name "%s"' % slack_name,failed=True)
+    die = params.target_die
+    if not die:
+        return SlackResponse('Format is w5 or white 5 (or b1 or black 1)',failed=True)
     if not game.take_die_from(die,user_id):
-        return SlackResponse(u'%s does not have a %s' % (user_name, die))
+        return SlackResponse(u'%s does not have a %s' % (user_name, die),failed=True)
     if slack_name == 'pool':
-        dice = game.dice
-        dice.append(die)
-        game.dice = dice
+        game.return_die_to_pool(die)
     else:
         game.give_die_to(die,to_player_id)
     return SlackResponse(u"%s gave %s to %s" % (user_name,die.to_emoji(),slack_name),True)
 
 def roll(game,params,user_id,user_name):
     """ Roll a user's dice and show the sum """
-    dice = game.get_user_dice(user_id)
-    if not dice:
-        return SlackResponse("You have no dice.")
-    dx = sum([x.roll() for x in dice if x.color == 'white']) - sum([x.roll() for x in dice if x.color == 'black'])
-    rolled = game.format_dice_pool(dice)
+    pool = game.get_user_pool(user_id)
+    if not pool:
+        return SlackResponse("You have no dice.",failed=True)
+    pool = DicePool.rolled(pool.count('white'),pool.count('black'))
+    dx = sum(number*(white-black) for number,white,black in
+             zip(Die.DIE_RANGE,pool.counts['white'],pool.counts['black']))
+    rolled = game.format_dice_pool(list(pool))
     if dx > 0:
         return SlackResponse("%s rolled %s totalling white %d" % (user_name,rolled,dx),True)
     elif dx < 0:
         return SlackResponse("%s rolled %s totalling black %d" % (user_name,rolled,abs(dx)),True)
     return SlackResponse("%s rolled %s totalling 0." % (user_name,rolled),True)   
 
+def odds(game,params,user_id,user_name):
+    """ Show the odds of a roll coming up white or black, for your dice or for a given
+    number of white and black dice """
+    if params:
+        try:
+            white,black = int(params[0]),int(params[1])
+        except (ValueError,IndexError):
+            white = black = -1
+        if len(params) != 2 or not 0 <= white <= fiasco_odds.MAX_DICE or not 0 <= black <= fiasco_odds.MAX_DICE:
+            return SlackResponse("Usage: /fiasco odds [white_count black_count], each at most %d" % fiasco_odds.MAX_DICE,
+                                 failed=True)
+    else:
+        pool = game.get_user_pool(user_id)
+        white,black = pool.count('white'),pool.count('black')
+        if not white and not black:
+            return SlackResponse("You have no dice.",failed=True)
+        if white > fiasco_odds.MAX_DICE or black > fiasco_odds.MAX_DICE:
+            return SlackResponse("Odds are only worked out for up to %d dice of each color." % fiasco_odds.MAX_DICE,
+                                 failed=True)
+    o = fiasco_odds.outcome_odds(white,black)
+    return SlackResponse("%d white and %d black: white %.1f%% (average %.1f), black %.1f%% (average %.1f), zero %.1f%%" % (
+        white,black,o['white']*100,o['white_average'],o['black']*100,o['black_average'],o['zero']*100))
+
 def pool(game,params,user_id,user_name):
-    """ Output the dice pool. Based on parameters, optionally reset or reroll. """
-    dice = game.dice
+    """ Output the dice pool. Based on parameters, optionally reset or reroll.
+    With "all" after reset or reroll, do it for every table in the channel at once. """
+    games = [(None,game)]
+    if params[1:] == ['all']:
+        games += game.tables()
+        params = params[:1]
     if params == ['reset']:
-        # Reset dice
-        dice = []
-        user_count = len(game.users)
-        if not user_count:
-            return SlackResponse("No registered users so no dice rolled. /fiasco register Your Name to register yourself.")
-        for color in ('black','white'):
-            for i in range((user_count*2)):
-                dice.append(Die(color=color,number=random.randint(1,6)))
-        game.dice = dice
+        # Two dice of each color per player, rolled in one go
+        games = [(name,g) for name,g in games if g.users]
+        if not games:
+            return SlackResponse("No registered users so no dice rolled. /fiasco register Your Name to register yourself.",failed=True)
+        for name,g in games:
+            count = len(g.users)*2
+            g.pool = DicePool.rolled(count,count)
     elif params == ['reroll']:
         # Reroll dice still in pool
-        dice = game.dice
-        for die in dice:
-            die.roll()
-        game.dice = dice
- 
-    return SlackResponse(game.format_dice_pool(dice) or "No dice in pool",True)
+        for name,g in games:
+            dice = g.pool
+            dice.reroll()
+            g.pool = dice
+
+    pools = [list(g.pool) for name,g in games]
+    if len(games) == 1 and games[0][0] is None:
+        return SlackResponse(game.format_dice_pool(pools[0]) or "No dice in pool",True,image_url=dice_image(pools))
+    return SlackResponse(u'\n'.join(u'%s: %s' % (name or 'Channel',g.format_dice_pool(dice) or "No dice in pool")
+                                    for (name,g),dice in zip(games,pools)),True,image_url=dice_image(pools))
 
 def spend(game,params,user_id,user_name):
     """ Let a user spend one of their dice """
-    dice = game.get_user_dice(user_id)
-    try:
-        die = Die(params=params)
-    except InvalidDie:
-        return SlackResponse('Format is w5 or white 5 (or b1 or black 1)')
+    die = params.die
+    if not die:
+        return SlackResponse('Format is w5 or white 5 (or b1 or black 1)',failed=True)
     
-    for i,d in enumerate(dice):
-        if die.to_json() == d.to_json():
-            del dice[i]
-            game.set_user_dice(user_id,dice)
-            return SlackResponse("%s spent %s" % (user_name, die.to_emoji()),True)
+    if game.take_die_from(die,user_id):
+        return SlackResponse("%s spent %s" % (user_name, die.to_emoji()),True)
        
-    return SlackResponse("You don't have a %s" % die.to_emoji())
+    return SlackResponse("You don't have a %s" % die.to_emoji(),failed=True)
 
+# The commands below read the game's event log instead of a loaded game, so they are
+# called with the storage backend and game id rather than a Game.
+
+# How far back undo looks for a change to undo
+UNDO_DEPTH = 50
+# Most changes history shows at once
+MAX_HISTORY = 100
+
+def history(backend,game_id,params,user_id,user_name):
+    """ Show the most recent changes to the game """
+    try:
+        count = int(params[0]) if params else 10
+    except ValueError:
+        count = 0
+    if not 1 <= count <= MAX_HISTORY:
+        return SlackResponse("Usage: /fiasco history [count], count from 1 to %d" % MAX_HISTORY,failed=True)
+    events = backend.events(game_id,limit=count)
+    if not events:
+        return SlackResponse("No history yet.")
+    undone = set(e['undoes'] for e in events if 'undoes' in e)
+    lines = []
+    for event in reversed(events):
+        line = u'%d) %s: %s' % (event['version'],event.get('user'),event.get('command'))
+        if event['version'] in undone:
+            line += u' (undone)'
+        lines.append(line)
+    return SlackResponse(u'\n'.join(lines))
+
+def undo(backend,game_id,params,user_id,user_name):
+    """ Undo the most recent change that has not already been undone """
+    events = backend.events(game_id,limit=UNDO_DEPTH)
+    undone = set()
+    for event in events:
+        if 'undoes' in event:
+            undone.add(event['undoes'])
+        elif event['version'] not in undone:
+            break
+    else:
+        return SlackResponse("Nothing to undo.",failed=True)
+    if 'document' in event:
+        return SlackResponse(u'"%s" cannot be undone' % event.get('command'),failed=True)
+
+    # Every later change has been undone, so the game is as this event left it
+    version = events[0]['version']
+    now = int(time.time())
+    sets = dict(event['before'],_last_active=now)
+    try:
+        backend.update(game_id,sets,event['missing'],version)
+    except VersionConflict:
+        return SlackResponse("The game changed while undoing. Please try again.",failed=True)
+    backend.append_event(game_id,{'version': version+1, 'command': 'undo', 'undoes': event['version'],
+                                  'user': user_name, 'user_id': user_id, 'time': now,
+                                  'sets': sets, 'unsets': event['missing']})
+    return SlackResponse(u'%s undid "%s" by %s' % (user_name,event.get('command'),event.get('user')),True)
@@ -0,0 +1,82 @@
+""" Runs commands on background threads and delivers the reply to Slack's response_url.
+Slack gives up on a slash command after 3 seconds, so in deferred mode the web request
+only acknowledges and the real response is POSTed here once it is ready.
+"""
+import collections
+import logging
+import os
+import Queue
+import threading
+import time
+
+class DeferredResponder(object):
+    def __init__(self,handler,workers=2,timeout=5):
+        """ handler is called with the queued arguments and returns a dict to post """
+        self.handler = handler
+        self.workers = workers
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.session = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=1000)
+        self.delivered = self.failed = 0
+
+    def start(self):
+        """ Start worker threads and the HTTP session for this process. Threads do not
+        survive a fork, so a preloaded app starts its own in each worker on first use. """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            import requests # Only needed in deferred mode
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.workers)
+            self.session.mount('https://',adapter)
+            self.session.mount('http://',adapter)
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.run,name='deferred-%d' % i)
+                thread.daemon = True
+                thread.start()
+            self.pid = os.getpid()
+
+    def submit(self,response_url,*args):
+        self.start()
+        self.queue.put((time.time(),response_url,args))
+
+    def join(self):
+        """ Wait until everything queued so far has been delivered """
+        self.queue.join()
+
+    def run(self):
+        while True:
+            queued_at,response_url,args = self.queue.get()
+            try:
+                self.deliver(queued_at,response_url,args)
+            finally:
+                self.queue.task_done()
+
+    def deliver(self,queued_at,response_url,args):
+        import requests
+        try:
+            response = self.handler(*args)
+        except Exception, e:
+            logging.error(e)
+            response = {'text': 'Whoops! Error.'}
+        try:
+            self.session.post(response_url,json=response,timeout=self.timeout).raise_for_status()
+        except requests.RequestException, e:
+            logging.error('Could not deliver to %s: %s' % (response_url,e))
+            self.failed += 1
+            return
+        self.delivered += 1
+        self.latencies.append(time.time()-queued_at)
+
+    def stats(self):
+        """ Queue depth, delivery counts and latency (seconds from submit to delivery) """
+        latencies = sorted(self.latencies)
+        stats = {'queue_depth': self.queue.qsize(), 'delivered': self.delivered, 'failed': self.failed}
+        if latencies:
+            stats['latency_p50'] = latencies[len(latencies)/2]
+            stats['latency_p99'] = latencies[min(len(latencies)-1,len(latencies)*99/100)]
+            stats['latency_max'] = latencies[-1]
+        return stats
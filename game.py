@@ -1,40 +1,150 @@
+import copy
 import random
 import re
 import logging
-import pymongo
+import time
+
+import storage
+from storage import VersionConflict
 
 class SlackResponse(object):
-    def __init__(self,text,in_channel=False):
+    def __init__(self,text,in_channel=False,failed=False,image_url=None):
+        """ failed marks responses to commands that could not be carried out.
+        image_url is shown below the text, e.g. a picture of the dice. """
         self.text = text
+        self.failed = failed
+        self.image_url = image_url
         if in_channel:
             self.response_type='in_channel'
         else:
             self.response_type='ephemeral'
 
     def to_json(self):
-        return {'text': self.text, 'response_type': self.response_type}
+        json = {'text': self.text, 'response_type': self.response_type}
+        if self.image_url:
+            json['attachments'] = [{'fallback': 'Dice', 'image_url': self.image_url}]
+        return json
 
 class InvalidDie(Exception):
     pass
 
+MISSING = object()
+
 class GameState(object):
-    def __init__(self,data=None):
+    """ Nested dict of game data. Paths are /-separated; changes made through put/delete
+    are tracked so save only writes the fields that changed. """
+    def __init__(self,data=None,backend=None):
         self.data = data or {}
+        self.backend = backend or storage.get_backend()
+        self.changes = {} # dotted field name -> True if set, False if unset
+        self.before = {} # dotted field name -> value before the first change, MISSING if absent
+        self.replace = bool(data) # Write the whole document on next save
+        self.version = self.data.get('_version',0)
 
-    def save(self,game_id):
-        client = pymongo.MongoClient()
-        db = client.fislacko
-        self.data['_id'] = game_id
-        db.games.replace_one({'_id': game_id},self.data,upsert=True)
+    def save(self,game_id,event=None):
+        """ Persist changes made since the last load/save. Does nothing if there are none.
+        Raises VersionConflict if the game was saved by someone else since it was loaded.
+        If event is a dict, the changes (and the values they replaced, so they can be undone)
+        are added to it and it is appended to the game's event log.
+        Every save also stamps the game's _last_active time, which decides when it is archived. """
+        now = int(time.time())
+        if self.replace:
+            self.data['_id'] = game_id
+            self.data['_last_active'] = now
+            self.backend.save(game_id,self.data,self.version)
+            if event is not None:
+                event['document'] = self.data
+        elif self.changes:
+            sets = dict((k,self._value(k)) for k,is_set in self.changes.items() if is_set)
+            unsets = [k for k,is_set in self.changes.items() if not is_set]
+            sets['_last_active'] = self.data['_last_active'] = now
+            self.backend.update(game_id,sets,unsets,self.version)
+            if event is not None:
+                event.update(sets=sets,unsets=unsets,
+                             before=dict((k,v) for k,v in self.before.items() if v is not MISSING),
+                             missing=[k for k,v in self.before.items() if v is MISSING])
+        else:
+            return
+        self.version += 1
+        self.data['_version'] = self.version
+        if event is not None:
+            event['version'] = self.version
+            self.backend.append_event(game_id,event)
+        if self.version % storage.setting('SNAPSHOT_INTERVAL') == 0:
+            self.backend.save_snapshot(game_id,self.version,self.data)
+        self.changes = {}
+        self.before = {}
+        self.replace = False
         
     def load(self,game_id):
-        client = pymongo.MongoClient()
-        db = client.fislacko
-        self.data = db.games.find_one({'_id': game_id}) or {}
+        """ Load game_id, bringing it back from the archive if it was archived, or from its
+        channel's key if it was saved before games were keyed by workspace """
+        self.data = (self.backend.load(game_id) or storage.restore(self.backend,game_id) or
+                     storage.restore_unkeyed(self.backend,game_id) or {})
+        self.changes = {}
+        self.before = {}
+        self.replace = False
+        self.version = self.data.get('_version',0)
+        if '' in self.data:
+            # Games saved before empty path segments were dropped kept the root game under ''
+            self.data.update(self.data.pop(''))
+            self.replace = True
+
+    def _parts(self,path):
+        return [part for part in path.split('/') if part]
+
+    def _value(self,field):
+        d = self.data
+        for part in field.split('.'):
+            d = d[part]
+        return d
+
+    def _lookup(self,parts):
+        d = self.data
+        for part in parts:
+            if not isinstance(d,dict) or part not in d:
+                return MISSING
+            d = d[part]
+        return d
+
+    def _remember(self,parts):
+        """ Keep the value at parts from before it is first changed """
+        for i in range(1,len(parts)+1):
+            if '.'.join(parts[:i]) in self.before:
+                return # Already kept, or inside a field that was kept whole
+        field = '.'.join(parts)
+        value = self._lookup(parts)
+        if value is not MISSING:
+            value = copy.deepcopy(value)
+        prefix = field + '.'
+        for existing in [k for k in self.before if k.startswith(prefix)]:
+            # Fields inside this one changed already, so put back their original values
+            original = self.before.pop(existing)
+            if isinstance(value,dict):
+                d = value
+                subparts = existing[len(prefix):].split('.')
+                for part in subparts[:-1]:
+                    d = d.setdefault(part,{})
+                if original is MISSING:
+                    d.pop(subparts[-1],None)
+                else:
+                    d[subparts[-1]] = original
+        self.before[field] = value
+
+    def _mark(self,parts,is_set):
+        """ Record a change to the field at parts, folding it into any overlapping change """
+        field = '.'.join(parts)
+        for i in range(1,len(parts)):
+            if self.changes.get('.'.join(parts[:i])):
+                return # An ancestor is rewritten whole, which covers this field
+        prefix = field + '.'
+        for existing in [k for k in self.changes if k.startswith(prefix)]:
+            del self.changes[existing]
+        self.changes[field] = is_set
 
     def get(self,path,subpath):
         d = self.data
-        for part in path.split('/'):
+        for part in self._parts(path):
             d = d.get(part)
             if not d:
                 return None
@@ -42,29 +152,41 @@ class GameState(object):
         return d
 
     def put(self,path,subpath,data):
+        parts = self._parts(path)
+        field = parts + [subpath]
+        d = self.data
+        for i,part in enumerate(parts):
+            if not d.get(part):
+                field = parts[:i+1] # Created here, so written whole
+                break
+            d = d[part]
+        self._remember(field)
         d = self.data
-        for part in path.split('/'):
+        for part in parts:
             if not d.get(part):
                 d[part] = {}
             d = d[part]
         d[subpath] = data
+        self._mark(field,True)
 
     def delete(self,path,subpath):
+        parts = self._parts(path)
         d = self.data
-        for part in path.split('/'):
+        for part in parts:
             d = d.get(part)
             if not d:
                 return None
-        try:
+        if subpath in d:
+            self._remember(parts + [subpath])
             del d[subpath]
-        except KeyError:
-            pass
+            self._mark(parts + [subpath],False)
 
     def __unicode__(self):
         return unicode(self.data)
 
 class Die(object):
     """ Abstracts a D6 that can be white or black """
+    __slots__ = ('color','number')
     DIE_RANGE = (1,2,3,4,5,6)
     COLORS = ('white','black')
     RX = re.compile('^([wb]|white|black)\s?(\d)$')
@@ -93,12 +215,6 @@ class Die(object):
         if self.color not in Die.COLORS:
             raise InvalidDie('Invalid color %s' % self.color)
     
-    def roll(self):
-        """ Roll a number for this die, storing it and returning it """
-        n = random.randint(1,6)
-        self.number =  n
-        return n
-
     def to_json(self):
         return {'n': self.number,'c': self.color}
 
@@ -108,13 +224,96 @@ class Die(object):
             extra = '-black'
         return u':d6-%d%s:' % (self.number,extra)
 
+    def __eq__(self,other):
+        return isinstance(other,Die) and self.color == other.color and self.number == other.number
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.color,self.number))
+
+    def __repr__(self):
+        return 'Die(%r,%d)' % (self.color,self.number)
+
     def __unicode__(self):
         return u'%s %s' % (self.color, self.number)
 
+def roll_counts(count,rand=random.random):
+    """ Roll count dice at once. Returns how many came up on each face, ones first.
+    Every roll of dice, for the pool or a player, goes through this. """
+    sides = len(Die.DIE_RANGE)
+    counts = [0]*sides
+    for i in xrange(count):
+        counts[int(rand()*sides)] += 1
+    return counts
+
+class DicePool(object):
+    """ A bag of dice stored as a count per face for each color.
+    Stored as {'white': [ones,twos,...,sixes], 'black': [...]} """
+    __slots__ = ('counts',)
+    def __init__(self,dice=()):
+        self.counts = dict((color,[0]*len(Die.DIE_RANGE)) for color in Die.COLORS)
+        for die in dice:
+            self.add(die)
+
+    @classmethod
+    def from_json(cls,value):
+        """ Read a stored pool. Also accepts the older list of {'c','n'} dicts. """
+        if not value:
+            return cls()
+        if isinstance(value,list):
+            return cls(Die(json=x) for x in value)
+        pool = cls()
+        for color in Die.COLORS:
+            pool.counts[color] = list(value.get(color) or pool.counts[color])
+        return pool
+
+    @classmethod
+    def rolled(cls,white,black):
+        """ A pool of white and black dice, freshly rolled """
+        pool = cls()
+        pool.counts['white'] = roll_counts(white)
+        pool.counts['black'] = roll_counts(black)
+        return pool
+
+    def reroll(self):
+        """ Roll every die in the pool again """
+        for color,counts in self.counts.items():
+            self.counts[color] = roll_counts(sum(counts))
+
+    def to_json(self):
+        return dict((color,list(counts)) for color,counts in self.counts.items())
+
+    def add(self,die):
+        self.counts[die.color][die.number-1] += 1
+
+    def remove(self,die):
+        """ Remove one die matching die. Return False if there is none. """
+        counts = self.counts[die.color]
+        if not counts[die.number-1]:
+            return False
+        counts[die.number-1] -= 1
+        return True
+
+    def count(self,color=None):
+        if color:
+            return sum(self.counts[color])
+        return sum(sum(counts) for counts in self.counts.values())
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        for color in Die.COLORS:
+            for number,count in zip(Die.DIE_RANGE,self.counts[color]):
+                for i in range(count):
+                    yield Die(color=color,number=number)
+
 class Game(object):
-    def __init__(self,game_state):
+    def __init__(self,game_state,path=''):
         self.game_state = game_state
-        self.path = ''
+        self.path = path
 
     def format_dice_pool(self,dice):
         """ Take a list/tuple of dice and return them sorted into white and black dice, as emoji """
@@ -123,17 +322,33 @@ class Game(object):
         return u"%s %s"% (' '.join([x.to_emoji() for x in dice if x.color == 'white']),
             ' '.join([x.to_emoji() for x in dice if x.color == 'black']))
 
+    @property
+    def pool(self):
+        return DicePool.from_json(self.game_state.get(self.path,'dice'))
+
+    @pool.setter
+    def pool(self,value):
+        self.game_state.put(self.path,'dice',value.to_json())
+
     @property
     def dice(self):
-        return [Die(json=x) for x in self.game_state.get(self.path,'dice') or []]
+        return list(self.pool)
 
     @dice.setter
     def dice(self,value):
-        self.game_state.put(self.path,'dice',[x.to_json() for x in value])
+        self.pool = DicePool(value)
+
+    def tables(self):
+        """ (name, Game) for each of the parallel tables kept under this game's tables path.
+        A table is laid out like a game, e.g. {'tables': {'<name>': {'users': ..., 'dice': ...}}}
+        in the channel's document. No command creates them; operators add them to the store. """
+        return [(name,Game(self.game_state,'%s/tables/%s' % (self.path,name)))
+                for name in sorted(self.game_state.get(self.path,'tables') or {})]
 
     @property
     def setup(self):
-        return self.game_state.get(self.path,'setup') or []
+        """ A copy, so changing it before setting it back still leaves the old value for undo """
+        return list(self.game_state.get(self.path,'setup') or [])
 
     @setup.setter
     def setup(self,value):
@@ -146,56 +361,88 @@ class Game(object):
     def get_user(self,user_id):
         return self.game_state.get('%s/users' % self.path, user_id) or {}
 
+    @staticmethod
+    def slack_name_key(slack_name):
+        """ Case-folded slack name, escaped for use as a field name (slack names can contain dots) """
+        return slack_name.lower().replace('%','%25').replace('.','%2E').replace('$','%24')
+
+    def slack_names(self):
+        """ The slack name -> user id index kept next to the users map """
+        index = self.game_state.get(self.path,'slack_names')
+        if index is None and self.users:
+            # Games registered before the index existed
+            index = dict((self.slack_name_key(user.get('slack_name') or ''),user_id)
+                         for user_id,user in self.users.items())
+            self.game_state.put(self.path,'slack_names',index)
+        return index or {}
+
     def get_user_id_for_slack_name(self,slack_name):
         """ Return the user with the given slack name, or None if no match. Case insensitive """
-        for user_id,user in self.users.items():
-            if user.get('slack_name').lower() == slack_name.lower():
-                return user_id
-        return None
+        return self.slack_names().get(self.slack_name_key(slack_name))
+
+    def _unindex(self,user_id):
+        slack_name = self.get_user(user_id).get('slack_name')
+        if slack_name is not None and self.get_user_id_for_slack_name(slack_name) == user_id:
+            self.game_state.delete('%s/slack_names' % self.path,self.slack_name_key(slack_name))
 
     def unregister(self,user_id):
+        self._unindex(user_id)
         self.game_state.delete(u'%s/users' % (self.path,),user_id)
         
     def set_user(self,user_id,slack_name, game_name):
+        self.slack_names()
+        self._unindex(user_id)
         self.game_state.put('%s/users' % self.path,user_id, {'name': game_name, 'slack_name': slack_name})
+        self.game_state.put('%s/slack_names' % self.path,self.slack_name_key(slack_name),user_id)
+
+    def get_user_pool(self,user_id):
+        """ Return a user's dice as a DicePool """
+        return DicePool.from_json(self.game_state.get('%s/users/%s' % (self.path,user_id), 'dice'))
+
+    def set_user_pool(self,user_id,pool):
+        self.game_state.put('%s/users/%s' % (self.path,user_id), 'dice', pool.to_json())
 
     def get_user_dice(self,user_id):
         """ Return all dice for a user """
-        return [Die(json=x) for x in self.game_state.get('%s/users/%s' % (self.path,user_id), 'dice') or []]
+        return list(self.get_user_pool(user_id))
 
     def set_user_dice(self,user_id,dice):
         """ Set the dice for a user. Dice should be a list/tuple of Die objects """
-        self.game_state.put('%s/users/%s' % (self.path,user_id), 'dice', [x.to_json() for x in dice])
+        self.set_user_pool(user_id,DicePool(dice))
 
     def clear(self):
         """ Clear this game on.game_state """
         self.game_state.delete(self.path,'users')
+        self.game_state.delete(self.path,'slack_names')
         self.game_state.delete(self.path,'dice')
         self.game_state.delete(self.path,'setup')
 
     def take_die_from_pool(self,die):
         """ Take the specified die from the pool and persist results. Return True if successful, False if die not in pool """
-        dice = self.dice
-        for i,d in enumerate(dice):
-            if d.to_json() == die.to_json():
-                del dice[i]
-                self.dice = dice
-                return True
+        pool = self.pool
+        if pool.remove(die):
+            self.pool = pool
+            return True
         return False
 
+    def return_die_to_pool(self,die):
+        """ Put the specified die back in the pool."""
+        pool = self.pool
+        pool.add(die)
+        self.pool = pool
+        return True
+
     def take_die_from(self,die,from_user_id):
         """ Take the specifed die from the user with the given id then persist the results."""
-        dice = self.get_user_dice(from_user_id)
-        for i,d in enumerate(dice):
-            if die.to_json() == d.to_json():
-                del dice[i]
-                self.set_user_dice(from_user_id,dice)
-                return True
+        pool = self.get_user_pool(from_user_id)
+        if pool.remove(die):
+            self.set_user_pool(from_user_id,pool)
+            return True
         return False
 
     def give_die_to(self,die,to_user_id):
         """ Give the specified die to the specified user."""
-        dice = self.get_user_dice(to_user_id) or []
-        dice.append(die)
-        self.set_user_dice(to_user_id,dice)
+        pool = self.get_user_pool(to_user_id)
+        pool.add(die)
+        self.set_user_pool(to_user_id,pool)
         return True
@@ -0,0 +1,81 @@
+""" Parses the text of a slash command once, into the words and dice its handler needs.
+"""
+import re
+
+from game import Die
+
+def _die_specs():
+    """ Every way of writing a die, lowercased with spaces removed: w5, white5, b1, black1 """
+    specs = {}
+    for color in Die.COLORS:
+        for number in Die.DIE_RANGE:
+            for name in (color,color[0]):
+                specs['%s%d' % (name,number)] = (color,number)
+    return specs
+
+DIE_SPECS = _die_specs()
+COLOR_NAMES = frozenset(spec[:-1] for spec in DIE_SPECS)
+# One die as a whole word, or a color word followed by a number word, in lowercased text
+DIE_RX = re.compile(r'(?<![^ ])(%s) ?([%s])(?![^ ])' % ('|'.join(sorted(COLOR_NAMES,key=len,reverse=True)),
+                                                     ''.join(str(n) for n in Die.DIE_RANGE)))
+
+def _die(spec,new=object.__new__):
+    """ A Die for a DIE_SPECS entry, skipping the validation it has already passed """
+    die = new(Die)
+    die.color,die.number = spec
+    return die
+
+def tokenize(text):
+    """ Split command text into words. Runs of whitespace count as one separator. """
+    return text.split()
+
+def _die_of(words):
+    """ The die words name, if they are exactly one die: w5, white5, or white 5 """
+    if len(words) == 1:
+        spec = DIE_SPECS.get(words[0].lower())
+    elif len(words) == 2 and words[0].lower() in COLOR_NAMES:
+        spec = DIE_SPECS.get(words[0].lower() + words[1])
+    else:
+        return None
+    return spec and _die(spec)
+
+class Params(list):
+    """ The words after the command name, plus what they describe. Each is only worked out
+    when a handler asks for it, so commands that take no dice never look for any.
+    dice: the dice named, in order. "w5", "white 5" and "black 1" each name one die.
+    die: the die, if the words are exactly one die; otherwise None
+    target: the last word with any leading @, for commands aimed at a player
+    target_die: the die, if every word but the target is exactly one die; otherwise None
+    text: the words joined by single spaces """
+    __slots__ = ()
+
+    @property
+    def text(self):
+        return ' '.join(self)
+
+    @property
+    def target(self):
+        return self[-1].lstrip('@') if self else None
+
+    @property
+    def dice(self):
+        return [_die(DIE_SPECS[match.group(1) + match.group(2)]) for match in DIE_RX.finditer(self.text.lower())]
+
+    @property
+    def die(self):
+        return _die_of(self)
+
+    @property
+    def target_die(self):
+        return _die_of(self[:-1]) if len(self) > 1 else None
+
+class Command(object):
+    """ One parsed command: its lowercased name and Params """
+    __slots__ = ('name','params')
+
+    def __init__(self,words):
+        self.name = words[0].lower() if words else ''
+        self.params = Params(words[1:])
+
+    def __repr__(self):
+        return 'Command(%r,%r)' % (self.name,list(self.params))
@@ -0,0 +1 @@
+/home/mchristensen/fislacko_proj/bin/gunicorn -k gevent --worker-connections 100 -w 3 -b 0.0.0.0:8000 application:app
@@ -1 +1 @@
-/home/mchristensen/fislacko_proj/bin/gunicorn -w 3 -b 0.0.0.0:8000 application:app
+/home/mchristensen/fislacko_proj/bin/gunicorn --preload -w 3 -b 0.0.0.0:8000 application:app
@@ -0,0 +1,252 @@
+""" Dice images for Slack: the d6 emoji, a sprite sheet of them, and pictures of whole hands.
+
+Uses only zlib, so works wherever the app does. PNGs are handled as (width, height, rows),
+each row a bytearray of RGBA pixels. Only the 8-bit RGB(A), non-interlaced PNGs in emoji/
+are read.
+
+Build the emoji for uploading to Slack, and the sprite sheet, with:
+  python images.py build [--size 128] [--tile 32] [--out emoji/build]
+"""
+import argparse
+import collections
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import zlib
+
+EMOJI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'emoji')
+SIGNATURE = '\x89PNG\r\n\x1a\n'
+# Slack refuses emoji over 128 pixels or 64KB
+MAX_EMOJI_SIZE = 128
+MAX_EMOJI_BYTES = 64*1024
+TILE_SIZE = 32 # Pixels per die in sprites and hand images
+MAX_IMAGE_DICE = 200
+MAX_IMAGE_ROWS = 64 # Hands (players and pools) in one image
+# Dice in the widest row times the number of rows, which bounds the image's area. Enough
+# for a status of a dozen players with their pool.
+MAX_IMAGE_TILES = 640
+FACES = ['d6-%d%s' % (number,suffix) for suffix in ('','-black') for number in range(1,7)]
+
+def _chunks(data):
+    if not data.startswith(SIGNATURE):
+        raise ValueError('Not a PNG')
+    i = len(SIGNATURE)
+    while i < len(data):
+        length, = struct.unpack('>I',data[i:i+4])
+        yield data[i+4:i+8],data[i+8:i+8+length]
+        i += 12+length
+
+def _paeth(a,b,c):
+    p = a+b-c
+    pa,pb,pc = abs(p-a),abs(p-b),abs(p-c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+def decode(data):
+    """ Read a PNG into (width, height, RGBA rows) """
+    idat = []
+    for kind,body in _chunks(data):
+        if kind == 'IHDR':
+            width,height,depth,color,compression,filtering,interlace = struct.unpack('>IIBBBBB',body)
+            if depth != 8 or color not in (2,6) or interlace:
+                raise ValueError('Only 8-bit RGB/RGBA non-interlaced PNGs are supported')
+        elif kind == 'IDAT':
+            idat.append(body)
+    raw = zlib.decompress(''.join(idat))
+    bpp = 4 if color == 6 else 3
+    stride = width*bpp
+    rows = []
+    previous = bytearray(stride)
+    for y in range(height):
+        start = y*(stride+1)
+        kind = ord(raw[start])
+        row = bytearray(raw[start+1:start+1+stride])
+        if kind == 1:
+            for x in range(bpp,stride):
+                row[x] = (row[x]+row[x-bpp]) & 0xff
+        elif kind == 2:
+            for x in range(stride):
+                row[x] = (row[x]+previous[x]) & 0xff
+        elif kind == 3:
+            for x in range(stride):
+                row[x] = (row[x]+((row[x-bpp] if x >= bpp else 0)+previous[x])/2) & 0xff
+        elif kind == 4:
+            for x in range(stride):
+                left = row[x-bpp] if x >= bpp else 0
+                upper_left = previous[x-bpp] if x >= bpp else 0
+                row[x] = (row[x]+_paeth(left,previous[x],upper_left)) & 0xff
+        rows.append(row)
+        previous = row
+    if bpp == 3:
+        rows = [bytearray(''.join(str(row[x:x+3]) + '\xff' for x in range(0,stride,3))) for row in rows]
+    return width,height,rows
+
+def _chunk(kind,body):
+    return struct.pack('>I',len(body)) + kind + body + struct.pack('>I',zlib.crc32(kind+body) & 0xffffffff)
+
+def _filtered(row,previous):
+    """ row with the PNG filter that leaves the smallest sum of bytes (as signed values),
+    the usual guess at what compresses best. Tries none, sub and up. """
+    sub = bytearray(row)
+    for x in range(4,len(row)):
+        sub[x] = (row[x]-row[x-4]) & 0xff
+    up = bytearray((a-b) & 0xff for a,b in zip(row,previous))
+    cost = lambda r: sum(b if b < 128 else 256-b for b in r)
+    return min(('\x00' + str(row),'\x01' + str(sub),'\x02' + str(up)),key=lambda f: cost(bytearray(f[1:])))
+
+def encode(image,optimize=False):
+    """ Write (width, height, RGBA rows) as a PNG with no extra chunks. optimize compresses
+    hardest and also tries choosing a filter per row, keeping whichever is smaller. It is
+    slow, so is for build time. """
+    width,height,rows = image
+    unfiltered = ''.join('\x00' + str(row) for row in rows)
+    if optimize:
+        previous = bytearray(width*4)
+        filtered = []
+        for row in rows:
+            filtered.append(_filtered(row,previous))
+            previous = row
+        raw = min(zlib.compress(unfiltered,9),zlib.compress(''.join(filtered),9),key=len)
+    else:
+        raw = zlib.compress(unfiltered,6)
+    return (SIGNATURE + _chunk('IHDR',struct.pack('>IIBBBBB',width,height,8,6,0,0,0)) +
+            _chunk('IDAT',raw) + _chunk('IEND',''))
+
+def resize(image,size):
+    """ Shrink a square image to size x size by averaging the pixels each new one covers.
+    Images no bigger than that are returned as they are. """
+    width,height,rows = image
+    if width <= size:
+        return image
+    scale = float(width)/size
+    spans = [] # For each new pixel, the source pixels it covers and how much of each
+    for i in range(size):
+        start,end = i*scale,(i+1)*scale
+        spans.append([(j,min(end,j+1)-max(start,j)) for j in range(int(start),min(width,int(end+0.999999)))])
+    columns = [[(j*4,weight) for j,weight in span] for span in spans]
+    resized = []
+    for span in spans:
+        row = bytearray(size*4)
+        for x,column in enumerate(columns):
+            total = [0.0]*4
+            area = 0.0
+            for y,y_weight in span:
+                source = rows[y]
+                for offset,x_weight in column:
+                    weight = x_weight*y_weight
+                    alpha = source[offset+3]*weight
+                    # Weight colors by alpha so transparent pixels don't darken the edges
+                    total[0] += source[offset]*alpha
+                    total[1] += source[offset+1]*alpha
+                    total[2] += source[offset+2]*alpha
+                    total[3] += alpha
+                    area += weight
+            if total[3]:
+                row[x*4:x*4+3] = bytearray(int(round(total[c]/total[3])) for c in range(3))
+            row[x*4+3] = int(round(total[3]/area))
+        resized.append(row)
+    return size,size,resized
+
+def load_face(face,size):
+    with open(os.path.join(EMOJI_DIR,face + '.png'),'rb') as f:
+        return resize(decode(f.read()),size)
+
+def sprite_sheet(tiles,size):
+    """ One image with every face side by side in FACES order, and where each one is """
+    rows = [bytearray(''.join(str(tiles[face][2][y]) for face in FACES)) for y in range(size)]
+    positions = dict((face,{'x': i*size, 'y': 0, 'width': size, 'height': size}) for i,face in enumerate(FACES))
+    return (size*len(FACES),size,rows),positions
+
+def build(out,size=MAX_EMOJI_SIZE,tile=TILE_SIZE):
+    """ Write each face at no more than size pixels, optimized for upload as Slack emoji,
+    plus sprite.png and sprite.json with every face at tile pixels """
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    for face in FACES:
+        data = encode(load_face(face,min(size,MAX_EMOJI_SIZE)),optimize=True)
+        if len(data) > MAX_EMOJI_BYTES:
+            raise ValueError('%s is %d bytes, over the emoji limit' % (face,len(data)))
+        with open(os.path.join(out,face + '.png'),'wb') as f:
+            f.write(data)
+        print '%-16s %6d bytes (source %d)' % (face + '.png',len(data),
+                                              os.path.getsize(os.path.join(EMOJI_DIR,face + '.png')))
+    image,positions = sprite_sheet(dict((face,load_face(face,tile)) for face in FACES),tile)
+    with open(os.path.join(out,'sprite.png'),'wb') as f:
+        f.write(encode(image,optimize=True))
+    with open(os.path.join(out,'sprite.json'),'w') as f:
+        json.dump(positions,f,indent=2,sort_keys=True)
+    print '%-16s %6d bytes' % ('sprite.png',os.path.getsize(os.path.join(out,'sprite.png')))
+
+# Pictures of hands. A spec is rows separated by _, each row dice such as w5b2 (white 5,
+# black 2), so a status with three players and the pool is one image of four rows.
+SPEC_RX = re.compile(r'^(?:[wb][1-6])*(?:_(?:[wb][1-6])*)*$')
+
+def die_spec(dice):
+    """ The spec of one row of dice """
+    return ''.join('%s%d' % (die.color[0],die.number) for die in dice)
+
+class HandImages(object):
+    """ Renders specs to PNGs. Face tiles are loaded on first use, and the last max_size
+    images are kept with an ETag (a hash of their content). """
+    def __init__(self,tile=TILE_SIZE,max_size=256):
+        self.tile = tile
+        self.max_size = max_size
+        self.tiles = None
+        self.cache = collections.OrderedDict() # spec -> (etag, png)
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Load the face tiles if not yet loaded. A preloading master can call this so its
+        workers share them. """
+        if self.tiles is None:
+            tiles = {}
+            for face in FACES:
+                image = load_face(face,self.tile)
+                tiles[face[3:].replace('-black','b')] = [str(row) for row in image[2]]
+            self.tiles = tiles # e.g. '5' (white) and '5b' (black) -> rows
+        return self.tiles
+
+    def render(self,spec):
+        """ Return (etag, png) for spec. Raises ValueError if spec is not a valid one. """
+        with self.lock:
+            cached = self.cache.pop(spec,None)
+            if cached is not None:
+                self.cache[spec] = cached
+                return cached
+        separators = spec.count('_')
+        if separators >= MAX_IMAGE_ROWS or len(spec) > 2*MAX_IMAGE_DICE + separators or not SPEC_RX.match(spec):
+            raise ValueError('Invalid dice spec %s' % spec)
+        hands = [[row[i:i+2] for i in range(0,len(row),2)] for row in spec.split('_')]
+        if max(len(hand) for hand in hands)*len(hands) > MAX_IMAGE_TILES:
+            raise ValueError('Dice spec %s makes too big an image' % spec)
+        tiles = self.load()
+        size = self.tile
+        width = max(1,max(len(hand) for hand in hands))*size
+        blank = '\x00'*(width*4)
+        rows = []
+        for hand in hands:
+            faces = [tiles[die[1] + ('b' if die[0] == 'b' else '')] for die in hand]
+            for y in range(size):
+                row = ''.join(face[y] for face in faces)
+                rows.append(row + blank[len(row):])
+        png = encode((width,len(rows),rows))
+        result = (hashlib.sha1(png).hexdigest(),png)
+        with self.lock:
+            self.cache[spec] = result
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the d6 emoji and sprite sheet')
+    subparsers = parser.add_subparsers(dest='task')
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('--size',type=int,default=MAX_EMOJI_SIZE,help='largest emoji size in pixels')
+    build_parser.add_argument('--tile',type=int,default=TILE_SIZE,help='size of each face in the sprite sheet')
+    build_parser.add_argument('--out',default=os.path.join(EMOJI_DIR,'build'))
+    args = parser.parse_args()
+    build(args.out,args.size,args.tile)
@@ -0,0 +1,242 @@
+""" Load test: simulated Slack channels playing Fiasco against the app.
+
+Usage:
+  python loadtest.py [-c channels] [-p players] [-r rate] [-d seconds | -n requests]
+                     [-w workers] [-b memory|sqlite|mongo] [--url URL] [--secret SECRET]
+
+Every channel registers its players and resets its pool, then commands are sent at rate
+requests a second: players take, give, roll and spend dice and check status and the pool.
+Each is posted as Slack would, a signed form to /fiasco/. Without --url the app runs in this
+process on the -b store (memory by default; mongo uses MONGO_URI and MONGO_DATABASE from
+FISLACKO_SETTINGS). With --url a running server is tested, and --secret must match its
+SLACK_SIGNING_SECRET.
+
+Reports throughput, latency percentiles (from when each request was due to be sent, so a
+server falling behind shows up as latency), errors, and consistency violations: at the end
+every channel's status must still account for every die it was dealt, less those spent.
+"""
+import argparse
+import collections
+import json
+import os
+import Queue
+import random
+import re
+import tempfile
+import threading
+import time
+import urllib
+
+TEST_SETTINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)),'test_settings.cfg')
+DICE = ['%s%d' % (color,number) for color in 'wb' for number in range(1,7)]
+# How often players send each command once the game is set up
+MIX = (('take',30),('give',20),('roll',15),('spend',10),('status',20),('pool',5))
+DIE_RX = re.compile(r':d6-\d(-black)?:')
+
+def percentile(timings,pct):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered)-1,int(len(ordered)*pct/100.0))]
+
+class InProcessClient(object):
+    """ Posts to the app in this process through Flask's test client """
+    def __init__(self,secret):
+        os.environ.setdefault('FISLACKO_SETTINGS',TEST_SETTINGS)
+        import application
+        application.app.config['SLACK_SIGNING_SECRET'] = secret
+        self.app = application.app
+        self.local = threading.local()
+
+    def post(self,body,headers):
+        client = getattr(self.local,'client',None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.post('/fiasco/',data=body,headers=headers,
+                               content_type='application/x-www-form-urlencoded')
+        return response.status_code,response.status_code == 200 and json.loads(response.data)
+
+class HttpClient(object):
+    def __init__(self,url,workers):
+        import requests
+        self.url = url
+        self.session = requests.Session()
+        self.session.mount(url,requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=workers))
+
+    def post(self,body,headers):
+        headers = dict(headers,**{'Content-Type': 'application/x-www-form-urlencoded'})
+        response = self.session.post(self.url,data=body,headers=headers,timeout=10)
+        return response.status_code,response.ok and response.json()
+
+class Channel(object):
+    """ One simulated channel and what the load test knows about its game """
+    def __init__(self,channel_id,players):
+        self.channel_id = channel_id
+        self.players = ['%s-p%d' % (channel_id,i) for i in range(players)]
+        self.spent = collections.Counter() # color -> dice spent, from replies
+        self.lock = threading.Lock()
+
+class LoadTest(object):
+    def __init__(self,client,channels,players,secret,seed=None):
+        os.environ.setdefault('FISLACKO_SETTINGS',TEST_SETTINGS) # For signing with application.signature
+        self.client = client
+        self.secret = secret
+        self.channels = [Channel('LOAD%05d' % i,players) for i in range(channels)]
+        self.random = random.Random(seed)
+        self.results = collections.defaultdict(list) # command -> latencies of successes
+        self.errors = collections.Counter() # command -> failed requests
+        self.lock = threading.Lock()
+
+    def send(self,channel,player,text):
+        """ Post one signed command. Returns the reply, or None if the request failed. """
+        from application import signature
+        body = urllib.urlencode({'token': 'loadtest', 'team_id': 'TLOAD', 'channel_id': channel.channel_id,
+                                 'user_id': player, 'user_name': player, 'command': '/fiasco', 'text': text})
+        timestamp = str(int(time.time()))
+        headers = {'X-Slack-Request-Timestamp': timestamp,
+                   'X-Slack-Signature': signature(self.secret,timestamp,body)}
+        try:
+            status,reply = self.client.post(body,headers)
+        except Exception:
+            return None
+        if status != 200 or not reply or reply.get('text') == 'Whoops! Error.':
+            return None
+        return reply
+
+    def command(self,channel,rnd):
+        """ A random command from a random player: (player, text) """
+        player = rnd.choice(channel.players)
+        name = rnd.choice([name for name,weight in MIX for i in range(weight)])
+        if name in ('take','spend'):
+            return player,'%s %s' % (name,rnd.choice(DICE))
+        if name == 'give':
+            return player,'give %s %s' % (rnd.choice(DICE),rnd.choice(channel.players + ['pool']))
+        return player,name
+
+    def run_one(self,channel,player,text,due):
+        reply = self.send(channel,player,text)
+        name = text.split(' ')[0]
+        with self.lock:
+            if reply is None:
+                self.errors[name] += 1
+            else:
+                self.results[name].append(time.time()-due)
+        if reply is not None and name == 'spend' and ' spent ' in reply['text']:
+            with channel.lock:
+                channel.spent['black' if '-black:' in reply['text'] else 'white'] += 1
+
+    def setup(self,workers):
+        """ Register every player and deal each channel its pool, channels in parallel """
+        def set_up(channel):
+            for player in channel.players:
+                self.run_one(channel,player,'register %s' % player,time.time())
+            self.run_one(channel,channel.players[0],'pool reset',time.time())
+        self._run(workers,((set_up,(channel,)) for channel in self.channels))
+
+    def load(self,workers,rate,duration=None,count=None):
+        """ Send commands at rate a second until duration seconds or count requests are done """
+        def jobs():
+            rnd = self.random
+            start = time.time()
+            i = 0
+            while (count is None or i < count) and (duration is None or i < rate*duration):
+                due = start + float(i)/rate
+                delay = due-time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                channel = rnd.choice(self.channels)
+                player,text = self.command(channel,rnd)
+                yield self.run_one,(channel,player,text,due)
+                i += 1
+        start = time.time()
+        self._run(workers,jobs())
+        return time.time()-start
+
+    def _run(self,workers,jobs):
+        queue = Queue.Queue(maxsize=workers*4)
+        def work():
+            while True:
+                job = queue.get()
+                if job is None:
+                    return
+                job[0](*job[1])
+        threads = [threading.Thread(target=work) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for job in jobs:
+            queue.put(job)
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def check(self):
+        """ Compare each channel's status with the dice it was dealt. Returns violations. """
+        violations = []
+        for channel in self.channels:
+            reply = self.send(channel,channel.players[0],'status')
+            if reply is None:
+                violations.append('%s: status failed' % channel.channel_id)
+                continue
+            players,_,pool = reply['text'].partition('\n\n')
+            if len(players.splitlines()) != len(channel.players):
+                violations.append('%s: %d players listed, %d registered' % (channel.channel_id,
+                                  len(players.splitlines()),len(channel.players)))
+            dice = DIE_RX.findall(reply['text'])
+            counts = {'black': dice.count('-black'), 'white': dice.count('')}
+            for color in ('white','black'):
+                dealt = 2*len(channel.players)
+                if counts[color] + channel.spent[color] != dealt:
+                    violations.append('%s: %d %s dice in play and %d spent, but %d were dealt' % (
+                                      channel.channel_id,counts[color],color,channel.spent[color],dealt))
+        return violations
+
+    def report(self,elapsed,violations):
+        sent = sum(len(v) for v in self.results.values()) + sum(self.errors.values())
+        print '%d requests in %.1fs: %.1f requests/sec' % (sent,elapsed,sent/elapsed)
+        print '%-10s %7s %7s %9s %9s %9s %9s' % ('command','ok','errors','p50 ms','p95 ms','p99 ms','max ms')
+        everything = []
+        for name in sorted(set(self.results) | set(self.errors)):
+            timings = self.results.get(name) or [0]
+            everything.extend(self.results.get(name,[]))
+            print '%-10s %7d %7d %9.2f %9.2f %9.2f %9.2f' % (name,len(self.results.get(name,[])),self.errors[name],
+                1000*percentile(timings,50),1000*percentile(timings,95),1000*percentile(timings,99),1000*max(timings))
+        if everything:
+            print '%-10s %7d %7d %9.2f %9.2f %9.2f %9.2f' % ('all',len(everything),sum(self.errors.values()),
+                1000*percentile(everything,50),1000*percentile(everything,95),1000*percentile(everything,99),
+                1000*max(everything))
+        print 'error rate %.3f%%' % (100.0*sum(self.errors.values())/max(1,sent))
+        print '%d consistency violations' % len(violations)
+        for violation in violations[:10]:
+            print '  ' + violation
+
+def configure_store(backend):
+    import storage
+    settings = {'STORAGE_BACKEND': backend}
+    if backend == 'sqlite':
+        settings['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(),'loadtest.db')
+    storage.configure(settings)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the fislacko service')
+    parser.add_argument('-c','--channels',type=int,default=1000)
+    parser.add_argument('-p','--players',type=int,default=4)
+    parser.add_argument('-r','--rate',type=float,default=200,help='requests a second once set up')
+    parser.add_argument('-d','--duration',type=float,default=30,help='seconds to send for')
+    parser.add_argument('-n','--requests',type=int,help='send this many instead of for a duration')
+    parser.add_argument('-w','--workers',type=int,default=16,help='requests in flight at once')
+    parser.add_argument('-b','--backend',choices=('memory','sqlite','mongo'),default='memory')
+    parser.add_argument('--url',help='test a running server instead, e.g. http://localhost:8000/fiasco/')
+    parser.add_argument('--secret',default='loadtest-secret',help='Slack signing secret')
+    parser.add_argument('--seed',type=int)
+    args = parser.parse_args()
+    if args.url:
+        client = HttpClient(args.url,args.workers)
+    else:
+        client = InProcessClient(args.secret)
+        configure_store(args.backend)
+    test = LoadTest(client,args.channels,args.players,args.secret,args.seed)
+    test.setup(args.workers)
+    test.results.clear()
+    test.errors.clear()
+    elapsed = test.load(args.workers,args.rate,None if args.requests else args.duration,args.requests)
+    test.report(elapsed,test.check())
@@ -0,0 +1,79 @@
+""" Maintenance tasks for the game store, run against every shard.
+
+Usage:
+  python maintenance.py report [--days N]
+      Working-set size: live games and their size, how many have been idle for N days
+      (ARCHIVE_AFTER_DAYS by default), and what is archived.
+  python maintenance.py archive [--days N] [--dry-run]
+      Move games idle for N days to the archive. They come back the next time they are used.
+Settings are read from FISLACKO_SETTINGS, as by the app.
+"""
+import argparse
+import json
+import time
+
+import storage
+
+DAY = 24*60*60
+
+def shards():
+    """ The default shard (None) and every named one """
+    return [None] + sorted(storage.setting('SHARDS'))
+
+def working_set(backend,idle_before):
+    """ Count and size (as JSON) the live games, those idle since before idle_before,
+    and the archived ones (compressed) """
+    report = dict.fromkeys(('games','bytes','idle','idle_bytes','archived','archived_bytes'),0)
+    for game_id in backend.game_ids():
+        document = backend.load(game_id)
+        if document is None:
+            continue
+        size = len(json.dumps(document))
+        report['games'] += 1
+        report['bytes'] += size
+        if storage.last_active(backend,game_id,document) < idle_before:
+            report['idle'] += 1
+            report['idle_bytes'] += size
+    for game_id in backend.archived_ids():
+        data = backend.load_archive(game_id)
+        if data is not None:
+            report['archived'] += 1
+            report['archived_bytes'] += len(data)
+    return report
+
+def archive_idle(backend,idle_before,dry_run=False):
+    """ Archive every game idle since before idle_before. Returns the ids archived. """
+    archived = []
+    for game_id in backend.game_ids():
+        if dry_run:
+            document = backend.load(game_id)
+            if document is not None and storage.last_active(backend,game_id,document) < idle_before:
+                archived.append(game_id)
+        elif storage.archive(backend,game_id,idle_before) is not None:
+            archived.append(game_id)
+    return archived
+
+if __name__ == '__main__':
+    from flask import Config
+    parser = argparse.ArgumentParser(description='Maintain the fislacko game store')
+    parser.add_argument('task',choices=('report','archive'))
+    parser.add_argument('--days',type=float,help='idle days before a game is archived')
+    parser.add_argument('--dry-run',action='store_true',help='only list what would be archived')
+    args = parser.parse_args()
+    config = Config('.')
+    config.from_envvar('FISLACKO_SETTINGS')
+    storage.configure(config)
+    idle_before = time.time() - DAY*(args.days or storage.setting('ARCHIVE_AFTER_DAYS'))
+    if args.task == 'report':
+        print '%-12s %8s %10s %8s %10s %9s %10s' % ('shard','games','bytes','idle','idle bytes',
+                                                   'archived','archived bytes')
+    for shard in shards():
+        backend = storage.shard_backend(shard)
+        if args.task == 'report':
+            report = working_set(backend,idle_before)
+            print '%-12s %8d %10d %8d %10d %9d %10d' % (shard or 'default',report['games'],report['bytes'],
+                report['idle'],report['idle_bytes'],report['archived'],report['archived_bytes'])
+        else:
+            archived = archive_idle(backend,idle_before,args.dry_run)
+            print '%s: %s %d games %s' % (shard or 'default','would archive' if args.dry_run else 'archived',
+                                          len(archived),' '.join(archived))
@@ -0,0 +1,143 @@
+""" Per-process counters and histograms, rendered in the Prometheus text format.
+Each gunicorn worker keeps its own, so scrape every worker or sum across them.
+"""
+import bisect
+import collections
+import contextlib
+import json
+import logging
+import threading
+import time
+
+BUCKETS = (0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5)
+SIZE_BUCKETS = (256,1024,4096,16384,65536,262144,1048576)
+
+_metrics = []
+_lock = threading.Lock()
+
+def _labels(labels,extra=()):
+    pairs = sorted(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k,v) for k,v in pairs)
+
+class Counter(object):
+    def __init__(self,name,help):
+        self.name = name
+        self.help = help
+        self.values = collections.defaultdict(float)
+        _metrics.append(self)
+
+    def inc(self,amount=1,**labels):
+        with _lock:
+            self.values[tuple(sorted(labels.items()))] += amount
+
+    def get(self,**labels):
+        return self.values.get(tuple(sorted(labels.items())),0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name,self.help),'# TYPE %s counter' % self.name]
+        for labels,value in sorted(self.values.items()):
+            lines.append('%s%s %s' % (self.name,_labels(labels),repr(value)))
+        return lines
+
+class Histogram(object):
+    def __init__(self,name,help,buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {} # labels -> [count in each bucket (not cumulative)..., overflow, sum, count]
+        _metrics.append(self)
+
+    def observe(self,value,**labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0]*(len(self.buckets)+3)
+            series[bisect.bisect_left(self.buckets,value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self,**labels):
+        return self.series.get(tuple(sorted(labels.items())),[0])[-1]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name,self.help),'# TYPE %s histogram' % self.name]
+        for labels,series in sorted(self.series.items()):
+            count = 0
+            for bound,in_bucket in zip(self.buckets,series):
+                count += in_bucket
+                lines.append('%s_bucket%s %d' % (self.name,_labels(labels,[('le',repr(bound))]),count))
+            lines.append('%s_bucket%s %d' % (self.name,_labels(labels,[('le','+Inf')]),series[-1]))
+            lines.append('%s_sum%s %s' % (self.name,_labels(labels),repr(series[-2])))
+            lines.append('%s_count%s %d' % (self.name,_labels(labels),series[-1]))
+        return lines
+
+class Gauge(object):
+    """ A value read when metrics are rendered. fn returns a number, or None to skip it. """
+    def __init__(self,name,help,fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        _metrics.append(self)
+
+    def render(self):
+        value = self.fn()
+        if value is None:
+            return []
+        return ['# HELP %s %s' % (self.name,self.help),'# TYPE %s gauge' % self.name,
+                '%s %s' % (self.name,repr(value))]
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+PHASE_SECONDS = Histogram('fislacko_command_phase_seconds','Time spent in each phase of a command')
+COMMAND_SECONDS = Histogram('fislacko_command_seconds','Total time to run a command')
+DOCUMENT_BYTES = Histogram('fislacko_document_bytes','Size of the game document after a command',SIZE_BUCKETS)
+COMMAND_ERRORS = Counter('fislacko_command_errors_total','Commands that raised an exception')
+SAVE_CONFLICTS = Counter('fislacko_save_conflicts_total','Saves retried because another command saved first')
+RATE_LIMITED = Counter('fislacko_rate_limited_total','Commands refused by a rate limit')
+COALESCED = Counter('fislacko_coalesced_total','Read-only commands answered with the result of an identical one in progress')
+
+class CommandTimer(object):
+    """ Times the load, command and save phases of one command. finish() records them
+    and writes a structured log line. """
+    def __init__(self,game_id,command):
+        self.game_id = game_id
+        self.command = command
+        self.phases = collections.OrderedDict((phase,0.0) for phase in ('load','command','save'))
+        self.started = time.time()
+        self.conflicts = 0
+        self.error = False
+        self.document = None
+
+    @contextlib.contextmanager
+    def phase(self,name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.time()-start
+
+    def finish(self):
+        total = time.time()-self.started
+        log = {'event': 'command', 'game_id': self.game_id, 'command': self.command,
+               'total_ms': round(total*1000,3), 'conflicts': self.conflicts, 'error': self.error}
+        for phase,seconds in self.phases.items():
+            PHASE_SECONDS.observe(seconds,command=self.command,phase=phase)
+            log['%s_ms' % phase] = round(seconds*1000,3)
+        COMMAND_SECONDS.observe(total,command=self.command)
+        if self.conflicts:
+            SAVE_CONFLICTS.inc(self.conflicts,command=self.command)
+        if self.error:
+            COMMAND_ERRORS.inc(command=self.command)
+        if self.document is not None:
+            size = len(json.dumps(self.document,default=str))
+            DOCUMENT_BYTES.observe(size,command=self.command)
+            log['document_bytes'] = size
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info(json.dumps(log))
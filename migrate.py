@@ -0,0 +1,48 @@
+""" Moves games saved before workspaces were told apart to their workspace's key and shard.
+
+Those games are keyed by channel alone. Each one is moved the first time its channel is
+used again (see storage.restore_unkeyed), so nothing needs doing after deploying. This
+moves them all at once instead, handing them to one workspace's team id, for a deployment
+that served a single workspace:
+
+  python migrate.py T0001 [--dry-run]
+
+Each game is copied with its version, event log and newest snapshot, then removed from
+its old key. Games the workspace has already started under the new key are left alone.
+Settings are read from FISLACKO_SETTINGS, as by the app.
+"""
+import argparse
+
+import storage
+
+def migrate(team_id,source,target,dry_run=False):
+    """ Move every game in source with a channel-only key to target, keyed for team_id.
+    Returns (moved, skipped) lists of the old keys. """
+    moved,skipped = [],[]
+    for old_id in sorted(source.game_ids()):
+        if ':' in old_id:
+            continue # Already keyed by workspace
+        new_id = storage.game_key(team_id,old_id)
+        if dry_run:
+            if source.load(old_id) is not None:
+                (skipped if target.load(new_id) is not None else moved).append(old_id)
+        elif storage.move(source,old_id,target,new_id):
+            moved.append(old_id)
+        elif source.load(old_id) is not None:
+            skipped.append(old_id)
+    return moved,skipped
+
+if __name__ == '__main__':
+    from flask import Config
+    parser = argparse.ArgumentParser(description='Key pre-workspace games by team')
+    parser.add_argument('team_id')
+    parser.add_argument('--dry-run',action='store_true',help='only report what would move')
+    args = parser.parse_args()
+    config = Config('.')
+    config.from_envvar('FISLACKO_SETTINGS')
+    storage.configure(config)
+    moved,skipped = migrate(args.team_id,storage.get_backend(),storage.get_backend(args.team_id),
+                            args.dry_run)
+    print '%s %d games: %s' % ('Would move' if args.dry_run else 'Moved',len(moved),' '.join(moved))
+    if skipped:
+        print 'Skipped %d games already started under %s: %s' % (len(skipped),args.team_id,' '.join(skipped))
@@ -0,0 +1,65 @@
+""" Exact odds for Fiasco rolls: the total of the white dice minus the total of the black.
+"""
+from game import Die
+
+SIDES = len(Die.DIE_RANGE)
+# Hands with up to this many dice of each color are cached. Larger ones are still
+# computed exactly, just not kept.
+TABLE_SIZE = 16
+# Odds are only worked out for hands with up to this many dice of each color
+MAX_DICE = 40
+
+_sums = [[1.0]] # _sums[n][t] = chance of n dice totalling t, for n up to TABLE_SIZE
+_table = {}
+
+def _add_die(previous):
+    chances = [0.0]*(len(previous)+SIDES)
+    for total,chance in enumerate(previous):
+        if chance:
+            chance /= SIDES
+            for face in Die.DIE_RANGE:
+                chances[total+face] += chance
+    return chances
+
+def sum_distribution(count):
+    """ Chance of count dice rolling each total, indexed by total """
+    if count > MAX_DICE:
+        raise ValueError('Odds are only worked out for up to %d dice of a color' % MAX_DICE)
+    while len(_sums) <= min(count,TABLE_SIZE):
+        _sums.append(_add_die(_sums[-1]))
+    chances = _sums[min(count,TABLE_SIZE)]
+    for i in range(TABLE_SIZE,count):
+        chances = _add_die(chances)
+    return chances
+
+def _outcomes(white,black):
+    whites = sum_distribution(white)
+    blacks = sum_distribution(black)
+    white_chance = black_chance = zero_chance = white_total = black_total = 0.0
+    for w,wc in enumerate(whites):
+        if not wc:
+            continue
+        for b,bc in enumerate(blacks):
+            chance = wc*bc
+            if w > b:
+                white_chance += chance
+                white_total += chance*(w-b)
+            elif b > w:
+                black_chance += chance
+                black_total += chance*(b-w)
+            else:
+                zero_chance += chance
+    return {'white': white_chance, 'black': black_chance, 'zero': zero_chance,
+            'white_average': white_chance and white_total/white_chance,
+            'black_average': black_chance and black_total/black_chance}
+
+def outcome_odds(white,black):
+    """ Return the chance that white/black dice end up white, black or zero, and the average
+    total for white and black results. Raises ValueError for more than MAX_DICE of a color. """
+    key = (white,black)
+    if key in _table:
+        return _table[key]
+    odds = _outcomes(white,black)
+    if white <= TABLE_SIZE and black <= TABLE_SIZE:
+        _table[key] = odds
+    return odds
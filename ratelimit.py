@@ -0,0 +1,31 @@
+""" Token bucket rate limits, kept per worker process.
+"""
+import collections
+import threading
+import time
+
+class RateLimiter(object):
+    """ A token bucket per key. Each bucket holds up to burst tokens and refills at rate
+    tokens a second; every allowed call takes one. Only the max_keys most recently used
+    buckets are kept, which is harmless: a forgotten bucket comes back full. """
+    def __init__(self,rate,burst,max_keys=10000):
+        self.rate = float(rate)
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = time.time
+        self.buckets = collections.OrderedDict() # key -> (tokens, time they were counted)
+        self.lock = threading.Lock()
+
+    def allow(self,key):
+        """ Take a token from key's bucket. Returns False if it is empty. """
+        now = self.clock()
+        with self.lock:
+            tokens,counted = self.buckets.pop(key,(self.burst,now))
+            tokens = min(self.burst,tokens + (now-counted)*self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens,now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return allowed
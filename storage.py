@@ -0,0 +1,784 @@
+""" Storage backends for game state.
+
+A backend stores one document (a dict) per game id. Which backend GameState uses is
+chosen by STORAGE_BACKEND in the FISLACKO_SETTINGS config:
+  mongo:  MongoDB, one pooled client per worker process (default)
+  memory: in-process dict, for tests and single-worker deployments
+  sqlite: a SQLite file in WAL mode, for small installs without a database server
+Setting CACHE_SIZE wraps the backend in a per-worker CachedBackend.
+
+Games are keyed by workspace and channel (see game_key). Workspaces can be given their
+own shard: SHARDS names each shard and the settings it overrides, e.g.
+  SHARDS = {'big': {'MONGO_DATABASE': 'fislacko_big'},
+            'small': {'MONGO_COLLECTION_PREFIX': 'small_'}}
+  TEAM_SHARDS = {'T0001': 'big'}
+Teams not listed use the top level settings. For other ways of choosing, set SHARD_ROUTER
+to a function taking a team id and returning a shard name or None.
+"""
+import collections
+import copy
+import json
+import os
+import threading
+import time
+import zlib
+
+DEFAULTS = {'STORAGE_BACKEND': 'mongo',
+            'MONGO_URI': 'mongodb://localhost:27017/',
+            'MONGO_DATABASE': 'fislacko',
+            'MONGO_MAX_POOL_SIZE': 10,
+            'MONGO_CONNECT_TIMEOUT_MS': 2000,
+            'MONGO_SERVER_SELECTION_TIMEOUT_MS': 2000,
+            'MONGO_SOCKET_TIMEOUT_MS': 5000,
+            'MONGO_COLLECTION_PREFIX': '',
+            'SQLITE_PATH': 'fislacko.db',
+            'CACHE_SIZE': 0,
+            'CACHE_TTL': 300,
+            'SNAPSHOT_INTERVAL': 50,
+            'ARCHIVE_AFTER_DAYS': 30,
+            'SHARDS': {},
+            'TEAM_SHARDS': {},
+            'SHARD_ROUTER': None}
+
+_settings = dict(DEFAULTS)
+_client = None
+_client_pid = None
+_backends = {} # shard name (None for the default) -> backend
+_lock = threading.Lock()
+
+def configure(config):
+    """ Read storage settings from a mapping (usually the Flask app config).
+    Any existing client or backend is dropped so the next call picks up the new settings. """
+    global _client, _backends
+    for key in DEFAULTS:
+        if key in config:
+            _settings[key] = config[key]
+    with _lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _backends = {}
+
+def setting(key):
+    return _settings[key]
+
+def get_client():
+    """ Return the MongoClient for this process, creating it on first use.
+    Clients are not fork-safe, so a worker forked from a parent that already had one
+    (e.g. gunicorn --preload) gets its own. """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    import pymongo
+    with _lock:
+        if _client is None or _client_pid != pid:
+            _client = pymongo.MongoClient(_settings['MONGO_URI'],
+                                          maxPoolSize=_settings['MONGO_MAX_POOL_SIZE'],
+                                          connectTimeoutMS=_settings['MONGO_CONNECT_TIMEOUT_MS'],
+                                          serverSelectionTimeoutMS=_settings['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+                                          socketTimeoutMS=_settings['MONGO_SOCKET_TIMEOUT_MS'],
+                                          connect=False)
+            _client_pid = pid
+    return _client
+
+def preload():
+    """ Import the configured backend's driver now, so a preloading master (gunicorn
+    --preload) does it once for every worker. Connections are still only made per
+    worker, after the fork. Drivers for other backends are never imported. """
+    if _settings['STORAGE_BACKEND'] == 'mongo':
+        import pymongo
+    elif _settings['STORAGE_BACKEND'] == 'sqlite':
+        import sqlite3
+
+def get_database(name=None):
+    return get_client()[name or _settings['MONGO_DATABASE']]
+
+def games():
+    """ The collection holding one document per game """
+    return get_database()[_settings['MONGO_COLLECTION_PREFIX'] + 'games']
+
+def events():
+    """ The collection holding each game's event log, one document per saved command """
+    return get_database()[_settings['MONGO_COLLECTION_PREFIX'] + 'events']
+
+def snapshots():
+    return get_database()[_settings['MONGO_COLLECTION_PREFIX'] + 'snapshots']
+
+def game_key(team_id,channel_id):
+    """ The id a game is stored under. Channel ids are only unique within a workspace.
+    Without a team (as in games saved before workspaces were told apart) it is the channel. """
+    if not team_id:
+        return channel_id
+    return '%s:%s' % (team_id,channel_id)
+
+def shard_for(team_id):
+    """ The name of the shard holding team_id's games, or None for the default """
+    if not team_id:
+        return None
+    router = _settings['SHARD_ROUTER']
+    if router is not None:
+        return router(team_id)
+    return _settings['TEAM_SHARDS'].get(team_id)
+
+class VersionConflict(Exception):
+    """ The stored document changed since it was loaded """
+    pass
+
+def version_of(document):
+    return (document or {}).get('_version',0)
+
+def apply_update(document,sets,unsets):
+    """ Apply $set/$unset style changes (dotted field names) to a document in place """
+    for field,value in sets.items():
+        parts = field.split('.')
+        d = document
+        for part in parts[:-1]:
+            if not isinstance(d.get(part),dict):
+                d[part] = {}
+            d = d[part]
+        d[parts[-1]] = value
+    for field in unsets:
+        parts = field.split('.')
+        d = document
+        for part in parts[:-1]:
+            d = d.get(part)
+            if not isinstance(d,dict):
+                break
+        else:
+            d.pop(parts[-1],None)
+    return document
+
+class StorageBackend(object):
+    """ Interface for game storage. Documents are plain dicts keyed by game id.
+
+    Writes are compare-and-swap on the document's _version field (missing counts as 0):
+    they only apply if the stored version equals the version passed in, then store
+    version + 1. Otherwise they raise VersionConflict. """
+    def load(self,game_id):
+        """ Return the document for game_id, or None if there is none """
+        raise NotImplementedError
+
+    def version(self,game_id):
+        """ Return the stored version of game_id, 0 if there is none """
+        return version_of(self.load(game_id))
+
+    def save(self,game_id,data,version):
+        """ Store data as the whole document for game_id """
+        raise NotImplementedError
+
+    def update(self,game_id,sets,unsets,version):
+        """ Atomically set and unset the given dotted fields, creating the document if needed """
+        raise NotImplementedError
+
+    def insert(self,game_id,data):
+        """ Store data as is, version included, if there is no document for game_id.
+        Otherwise raise VersionConflict. For moving games between stores. """
+        raise NotImplementedError
+
+    def delete(self,game_id,version=None):
+        """ Remove game_id's document, events and snapshots. If version is given, only if
+        the document is still at that version; otherwise raise VersionConflict. """
+        raise NotImplementedError
+
+    def game_ids(self):
+        """ Every stored game id """
+        raise NotImplementedError
+
+    # Idle games are moved to an archive, each as one opaque compressed string. See archive().
+
+    def save_archive(self,game_id,data):
+        raise NotImplementedError
+
+    def load_archive(self,game_id):
+        """ Return the archived string for game_id, or None """
+        raise NotImplementedError
+
+    def delete_archive(self,game_id):
+        raise NotImplementedError
+
+    def archived_ids(self):
+        raise NotImplementedError
+
+    # Each game also has an append-only event log. Every event is a dict whose 'version' is
+    # the game version it produced, and snapshots of whole documents are kept now and then
+    # so a game can be rebuilt without replaying its entire log.
+
+    def append_event(self,game_id,event):
+        raise NotImplementedError
+
+    def events(self,game_id,limit=None,after=0):
+        """ Return events with a version greater than after, newest first """
+        raise NotImplementedError
+
+    def save_snapshot(self,game_id,version,data):
+        raise NotImplementedError
+
+    def load_snapshot(self,game_id,version=None):
+        """ Return (version, document) for the newest snapshot at or before version, or None """
+        raise NotImplementedError
+
+class MongoBackend(StorageBackend):
+    """ Games, events and snapshots collections in database (MONGO_DATABASE if None), with
+    names starting with prefix. Every MongoBackend shares this process's client. """
+    indexed_pid = None
+    def __init__(self,database=None,prefix=None):
+        self.database = database
+        self.prefix = _settings['MONGO_COLLECTION_PREFIX'] if prefix is None else prefix
+
+    def collection(self,name):
+        return get_database(self.database)[self.prefix + name]
+
+    def load(self,game_id):
+        return self.collection('games').find_one({'_id': game_id})
+
+    def version(self,game_id):
+        return version_of(self.collection('games').find_one({'_id': game_id},{'_version': True}))
+
+    def _write(self,game_id,version,write):
+        import pymongo.errors
+        if version:
+            query = {'_id': game_id, '_version': version}
+        else:
+            query = {'_id': game_id, '_version': {'$exists': False}}
+        try:
+            result = write(query)
+        except pymongo.errors.DuplicateKeyError:
+            # The upsert found no matching version, so tried to insert over the existing game
+            raise VersionConflict(game_id)
+        if not result.matched_count and result.upserted_id is None:
+            raise VersionConflict(game_id)
+
+    def save(self,game_id,data,version):
+        data = dict(data,_version=version+1)
+        self._write(game_id,version,lambda query: self.collection('games').replace_one(query,data,upsert=True))
+
+    def update(self,game_id,sets,unsets,version):
+        update = {'$set': dict(sets,_version=version+1)}
+        if unsets:
+            update['$unset'] = dict((field,'') for field in unsets)
+        self._write(game_id,version,lambda query: self.collection('games').update_one(query,update,upsert=True))
+
+    def insert(self,game_id,data):
+        import pymongo.errors
+        try:
+            self.collection('games').insert_one(dict(data,_id=game_id))
+        except pymongo.errors.DuplicateKeyError:
+            raise VersionConflict(game_id)
+
+    def delete(self,game_id,version=None):
+        query = {'_id': game_id}
+        if version is not None:
+            query['_version'] = version or {'$exists': False}
+        if not self.collection('games').delete_one(query).deleted_count and version is not None:
+            raise VersionConflict(game_id)
+        self.collection('events').delete_many({'game_id': game_id})
+        self.collection('snapshots').delete_many({'game_id': game_id})
+
+    def game_ids(self):
+        return [document['_id'] for document in self.collection('games').find({},{'_id': True})]
+
+    def save_archive(self,game_id,data):
+        import bson
+        self.collection('archive').replace_one({'_id': game_id},{'_id': game_id, 'data': bson.Binary(data)},
+                                               upsert=True)
+
+    def load_archive(self,game_id):
+        archived = self.collection('archive').find_one({'_id': game_id})
+        return archived and str(archived['data'])
+
+    def delete_archive(self,game_id):
+        self.collection('archive').delete_one({'_id': game_id})
+
+    def archived_ids(self):
+        return [document['_id'] for document in self.collection('archive').find({},{'_id': True})]
+
+    def _ensure_indexes(self):
+        if self.indexed_pid != os.getpid():
+            self.collection('events').create_index([('game_id',1),('version',-1)],unique=True)
+            self.collection('snapshots').create_index([('game_id',1),('version',-1)],unique=True)
+            self.indexed_pid = os.getpid()
+
+    # Events' sets and before are keyed by dotted field names, which Mongo refuses as keys,
+    # so they are stored as [[field, value], ...] lists
+    PAIRED = ('sets','before')
+
+    def stored_event(self,game_id,event):
+        """ The document event is stored as """
+        stored = dict(event,game_id=game_id)
+        for key in self.PAIRED:
+            if key in stored:
+                stored[key] = [[field,value] for field,value in sorted(stored[key].items())]
+        return stored
+
+    def append_event(self,game_id,event):
+        self._ensure_indexes()
+        self.collection('events').insert_one(self.stored_event(game_id,event))
+
+    def events(self,game_id,limit=None,after=0):
+        cursor = self.collection('events').find({'game_id': game_id, 'version': {'$gt': after}},
+                               {'_id': False, 'game_id': False}).sort('version',-1)
+        if limit:
+            cursor = cursor.limit(limit)
+        found = list(cursor)
+        for event in found:
+            for key in self.PAIRED:
+                if isinstance(event.get(key),list): # Events without dotted keys were once stored as dicts
+                    event[key] = dict((field,value) for field,value in event[key])
+        return found
+
+    def save_snapshot(self,game_id,version,data):
+        self._ensure_indexes()
+        self.collection('snapshots').replace_one({'game_id': game_id, 'version': version},
+                                {'game_id': game_id, 'version': version, 'data': data},upsert=True)
+
+    def load_snapshot(self,game_id,version=None):
+        query = {'game_id': game_id}
+        if version is not None:
+            query['version'] = {'$lte': version}
+        snapshot = self.collection('snapshots').find_one(query,sort=[('version',-1)])
+        return snapshot and (snapshot['version'],snapshot['data'])
+
+class MemoryBackend(StorageBackend):
+    """ Keeps documents in a dict. Copies on the way in and out so callers never share state. """
+    def __init__(self):
+        self.documents = {}
+        self.event_log = collections.defaultdict(list)
+        self.snapshots = collections.defaultdict(list)
+        self.archive = {}
+        self.lock = threading.Lock()
+
+    def load(self,game_id):
+        with self.lock:
+            return copy.deepcopy(self.documents.get(game_id))
+
+    def save(self,game_id,data,version):
+        with self.lock:
+            if version_of(self.documents.get(game_id)) != version:
+                raise VersionConflict(game_id)
+            self.documents[game_id] = copy.deepcopy(dict(data,_version=version+1))
+
+    def update(self,game_id,sets,unsets,version):
+        with self.lock:
+            document = self.documents.get(game_id) or {'_id': game_id}
+            if version_of(document) != version:
+                raise VersionConflict(game_id)
+            apply_update(document,copy.deepcopy(sets),unsets)
+            document['_version'] = version+1
+            self.documents[game_id] = document
+
+    def insert(self,game_id,data):
+        with self.lock:
+            if game_id in self.documents:
+                raise VersionConflict(game_id)
+            self.documents[game_id] = copy.deepcopy(dict(data,_id=game_id))
+
+    def delete(self,game_id,version=None):
+        with self.lock:
+            if version is not None and version_of(self.documents.get(game_id)) != version:
+                raise VersionConflict(game_id)
+            self.documents.pop(game_id,None)
+            self.event_log.pop(game_id,None)
+            self.snapshots.pop(game_id,None)
+
+    def game_ids(self):
+        with self.lock:
+            return list(self.documents)
+
+    def save_archive(self,game_id,data):
+        with self.lock:
+            self.archive[game_id] = data
+
+    def load_archive(self,game_id):
+        with self.lock:
+            return self.archive.get(game_id)
+
+    def delete_archive(self,game_id):
+        with self.lock:
+            self.archive.pop(game_id,None)
+
+    def archived_ids(self):
+        with self.lock:
+            return list(self.archive)
+
+    def append_event(self,game_id,event):
+        with self.lock:
+            self.event_log[game_id].append(copy.deepcopy(event))
+            self.event_log[game_id].sort(key=lambda e: e['version'])
+
+    def events(self,game_id,limit=None,after=0):
+        with self.lock:
+            found = [e for e in reversed(self.event_log.get(game_id,[])) if e['version'] > after]
+            return copy.deepcopy(found[:limit] if limit else found)
+
+    def save_snapshot(self,game_id,version,data):
+        with self.lock:
+            self.snapshots[game_id].append((version,copy.deepcopy(data)))
+            self.snapshots[game_id].sort()
+
+    def load_snapshot(self,game_id,version=None):
+        with self.lock:
+            for snapshot in reversed(self.snapshots.get(game_id,[])):
+                if version is None or snapshot[0] <= version:
+                    return copy.deepcopy(snapshot)
+        return None
+
+class SQLiteBackend(StorageBackend):
+    """ Stores each document as JSON in a single table. Connections are per thread. """
+    def __init__(self,path):
+        self.path = path
+        self.local = threading.local()
+        db = self.connection()
+        db.execute('CREATE TABLE IF NOT EXISTS games (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        for table in ('events','snapshots'):
+            db.execute('CREATE TABLE IF NOT EXISTS %s (game_id TEXT NOT NULL, version INTEGER NOT NULL, '
+                       'data TEXT NOT NULL, PRIMARY KEY (game_id, version))' % table)
+        db.execute('CREATE TABLE IF NOT EXISTS archive (id TEXT PRIMARY KEY, data BLOB NOT NULL)')
+
+    def connection(self):
+        db = getattr(self.local,'db',None)
+        if db is None or self.local.pid != os.getpid():
+            import sqlite3
+            db = sqlite3.connect(self.path,timeout=10,isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def load(self,game_id):
+        row = self.connection().execute('SELECT data FROM games WHERE id = ?',(game_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _write(self,game_id,version,change):
+        """ Run change on the stored document inside a write transaction """
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            document = self.load(game_id)
+            if version_of(document) != version:
+                raise VersionConflict(game_id)
+            document = change(document or {'_id': game_id})
+            document['_version'] = version+1
+            db.execute('INSERT OR REPLACE INTO games (id, data) VALUES (?, ?)',
+                       (game_id,json.dumps(document)))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def save(self,game_id,data,version):
+        self._write(game_id,version,lambda document: dict(data))
+
+    def update(self,game_id,sets,unsets,version):
+        self._write(game_id,version,lambda document: apply_update(document,sets,unsets))
+
+    def insert(self,game_id,data):
+        import sqlite3
+        try:
+            self.connection().execute('INSERT INTO games (id, data) VALUES (?, ?)',
+                                      (game_id,json.dumps(dict(data,_id=game_id))))
+        except sqlite3.IntegrityError:
+            raise VersionConflict(game_id)
+
+    def delete(self,game_id,version=None):
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if version is not None and version_of(self.load(game_id)) != version:
+                raise VersionConflict(game_id)
+            for table,column in (('games','id'),('events','game_id'),('snapshots','game_id')):
+                db.execute('DELETE FROM %s WHERE %s = ?' % (table,column),(game_id,))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def game_ids(self):
+        return [row[0] for row in self.connection().execute('SELECT id FROM games')]
+
+    def save_archive(self,game_id,data):
+        import sqlite3
+        self.connection().execute('INSERT OR REPLACE INTO archive (id, data) VALUES (?, ?)',
+                                  (game_id,sqlite3.Binary(data)))
+
+    def load_archive(self,game_id):
+        row = self.connection().execute('SELECT data FROM archive WHERE id = ?',(game_id,)).fetchone()
+        return row and str(row[0])
+
+    def delete_archive(self,game_id):
+        self.connection().execute('DELETE FROM archive WHERE id = ?',(game_id,))
+
+    def archived_ids(self):
+        return [row[0] for row in self.connection().execute('SELECT id FROM archive')]
+
+    def append_event(self,game_id,event):
+        self.connection().execute('INSERT INTO events (game_id, version, data) VALUES (?, ?, ?)',
+                                  (game_id,event['version'],json.dumps(event)))
+
+    def events(self,game_id,limit=None,after=0):
+        rows = self.connection().execute('SELECT data FROM events WHERE game_id = ? AND version > ? '
+                                         'ORDER BY version DESC LIMIT ?',(game_id,after,limit or -1))
+        return [json.loads(row[0]) for row in rows]
+
+    def save_snapshot(self,game_id,version,data):
+        self.connection().execute('INSERT OR REPLACE INTO snapshots (game_id, version, data) VALUES (?, ?, ?)',
+                                  (game_id,version,json.dumps(data)))
+
+    def load_snapshot(self,game_id,version=None):
+        if version is None:
+            row = self.connection().execute('SELECT version, data FROM snapshots WHERE game_id = ? '
+                                            'ORDER BY version DESC LIMIT 1',(game_id,)).fetchone()
+        else:
+            row = self.connection().execute('SELECT version, data FROM snapshots WHERE game_id = ? AND version <= ? '
+                                            'ORDER BY version DESC LIMIT 1',(game_id,version)).fetchone()
+        return row and (row[0],json.loads(row[1]))
+
+class CachedBackend(StorageBackend):
+    """ LRU cache of documents in front of another backend.
+
+    Each load only asks the backend for the stored version, and fetches the whole document
+    when it differs from the cached copy, so games changed by other workers are never served
+    stale. Writes go straight through (they must be compare-and-swap against the shared store)
+    and then update the cached copy, so the next load needs no refetch. Entries are evicted
+    when idle for longer than ttl seconds or when more than max_size games are cached. """
+    def __init__(self,backend,max_size,ttl):
+        self.backend = backend
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = time.time
+        self.entries = collections.OrderedDict() # game_id -> (document, expiry time)
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
+
+    def _cached(self,game_id):
+        with self.lock:
+            entry = self.entries.get(game_id)
+            if entry and entry[1] < self.clock():
+                del self.entries[game_id]
+                self.evictions += 1
+                return None
+            return entry and entry[0]
+
+    def _store(self,game_id,document):
+        with self.lock:
+            self.entries.pop(game_id,None)
+            self.entries[game_id] = (document,self.clock()+self.ttl)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self,game_id):
+        with self.lock:
+            if self.entries.pop(game_id,None):
+                self.invalidations += 1
+
+    def load(self,game_id):
+        cached = self._cached(game_id)
+        if cached is not None and version_of(cached) == self.backend.version(game_id):
+            self.hits += 1
+            self._store(game_id,cached)
+            return copy.deepcopy(cached)
+        self.misses += 1
+        if cached is not None:
+            self.invalidations += 1
+        document = self.backend.load(game_id)
+        if document is None:
+            self.invalidate(game_id)
+            return None
+        self._store(game_id,copy.deepcopy(document))
+        return document
+
+    def version(self,game_id):
+        return self.backend.version(game_id)
+
+    def save(self,game_id,data,version):
+        try:
+            self.backend.save(game_id,data,version)
+        except VersionConflict:
+            self.invalidate(game_id)
+            raise
+        self._store(game_id,copy.deepcopy(dict(data,_version=version+1)))
+
+    def update(self,game_id,sets,unsets,version):
+        try:
+            self.backend.update(game_id,sets,unsets,version)
+        except VersionConflict:
+            self.invalidate(game_id)
+            raise
+        cached = self._cached(game_id)
+        if cached is None or version_of(cached) != version:
+            self.invalidate(game_id)
+            return
+        document = apply_update(copy.deepcopy(cached),copy.deepcopy(sets),unsets)
+        document['_version'] = version+1
+        self._store(game_id,document)
+
+    def insert(self,game_id,data):
+        self.backend.insert(game_id,data)
+
+    def delete(self,game_id,version=None):
+        try:
+            self.backend.delete(game_id,version)
+        finally:
+            self.invalidate(game_id)
+
+    def game_ids(self):
+        return self.backend.game_ids()
+
+    def save_archive(self,game_id,data):
+        self.backend.save_archive(game_id,data)
+
+    def load_archive(self,game_id):
+        return self.backend.load_archive(game_id)
+
+    def delete_archive(self,game_id):
+        self.backend.delete_archive(game_id)
+
+    def archived_ids(self):
+        return self.backend.archived_ids()
+
+    def append_event(self,game_id,event):
+        self.backend.append_event(game_id,event)
+
+    def events(self,game_id,limit=None,after=0):
+        return self.backend.events(game_id,limit,after)
+
+    def save_snapshot(self,game_id,version,data):
+        self.backend.save_snapshot(game_id,version,data)
+
+    def load_snapshot(self,game_id,version=None):
+        return self.backend.load_snapshot(game_id,version)
+
+def rebuild(backend,game_id,version=None):
+    """ Rebuild game_id as it was at version (the latest if None) from its newest snapshot
+    at or before that version plus the events after it """
+    snapshot = backend.load_snapshot(game_id,version)
+    start,document = snapshot or (0,{'_id': game_id})
+    for event in reversed(backend.events(game_id,after=start)):
+        if version is not None and event['version'] > version:
+            continue
+        if 'document' in event:
+            document = copy.deepcopy(event['document'])
+        else:
+            apply_update(document,copy.deepcopy(event['sets']),event['unsets'])
+        document['_version'] = event['version']
+    return document
+
+def last_active(backend,game_id,document):
+    """ When game_id was last changed: its _last_active time, or for games saved before
+    that was kept, the time of its latest event (0 if it has none) """
+    if '_last_active' in document:
+        return document['_last_active']
+    events = backend.events(game_id,limit=1)
+    return events[0].get('time',0) if events else 0
+
+def archive(backend,game_id,idle_before):
+    """ Move game_id, with its events and newest snapshot, into the archive as one
+    compressed string, if it has been idle since before idle_before (a time). Returns the
+    archived size in bytes, or None if the game is in use or was changed meanwhile. """
+    document = backend.load(game_id)
+    if document is None or last_active(backend,game_id,document) >= idle_before:
+        return None
+    data = zlib.compress(json.dumps({'document': document, 'events': backend.events(game_id),
+                                     'snapshot': backend.load_snapshot(game_id)}))
+    backend.save_archive(game_id,data)
+    try:
+        backend.delete(game_id,version_of(document))
+    except VersionConflict:
+        backend.delete_archive(game_id) # Played again while being archived
+        return None
+    return len(data)
+
+def restore(backend,game_id):
+    """ Move game_id back out of the archive. Returns its document, or None if it was
+    not archived. """
+    data = backend.load_archive(game_id)
+    if data is None:
+        return None
+    archived = json.loads(zlib.decompress(data))
+    try:
+        backend.insert(game_id,archived['document'])
+    except VersionConflict:
+        return backend.load(game_id) # Restored by another worker first
+    logged = set(event['version'] for event in backend.events(game_id))
+    for event in reversed(archived['events']):
+        if event['version'] not in logged:
+            backend.append_event(game_id,event)
+    if archived['snapshot']:
+        backend.save_snapshot(game_id,*archived['snapshot'])
+    backend.delete_archive(game_id)
+    return archived['document']
+
+def move(source,old_id,target,new_id):
+    """ Move a game with its version, event log and newest snapshot from old_id in source
+    to new_id in target. Returns False, leaving both as they were, if target already has
+    a game at new_id (or source has none at old_id). """
+    document = source.load(old_id)
+    if document is None:
+        return False
+    try:
+        target.insert(new_id,dict(document,_id=new_id))
+    except VersionConflict:
+        return False
+    for event in reversed(source.events(old_id)):
+        target.append_event(new_id,event)
+    snapshot = source.load_snapshot(old_id)
+    if snapshot:
+        target.save_snapshot(new_id,snapshot[0],dict(snapshot[1],_id=new_id))
+    source.delete(old_id)
+    return True
+
+def restore_unkeyed(backend,game_id):
+    """ Move the game its channel played before workspaces were told apart, saved under the
+    channel id alone in the default shard (and maybe archived), to game_id. Returns its
+    document, or None if there is none. """
+    team_id,_,channel_id = game_id.partition(':')
+    if not channel_id:
+        return None
+    source = get_backend()
+    # Not version(): games saved before versions were kept have none
+    if source.load(channel_id) is not None or restore(source,channel_id) is not None:
+        move(source,channel_id,backend,game_id)
+        return backend.load(game_id) # Also if another worker moved it first
+    return None
+
+def create_backend(name=None,shard=None):
+    """ Create a backend from the settings, with shard's overrides if one is given """
+    settings = _settings
+    if shard is not None:
+        if shard not in _settings['SHARDS']:
+            raise ValueError('Unknown shard %s' % shard)
+        settings = dict(_settings,**_settings['SHARDS'][shard])
+    name = name or settings['STORAGE_BACKEND']
+    if name == 'mongo':
+        backend = MongoBackend(settings['MONGO_DATABASE'],settings['MONGO_COLLECTION_PREFIX'])
+    elif name == 'memory':
+        backend = MemoryBackend()
+    elif name == 'sqlite':
+        backend = SQLiteBackend(settings['SQLITE_PATH'])
+    else:
+        raise ValueError('Unknown storage backend %s' % name)
+    if settings['CACHE_SIZE']:
+        backend = CachedBackend(backend,settings['CACHE_SIZE'],settings['CACHE_TTL'])
+    return backend
+
+def get_backend(team_id=None):
+    """ Return this process's backend for team_id's shard (the default shard if None) """
+    return shard_backend(shard_for(team_id))
+
+def shard_backend(shard):
+    """ Return this process's backend for the named shard (the default shard if None) """
+    backend = _backends.get(shard)
+    if backend is None:
+        with _lock:
+            backend = _backends.get(shard)
+            if backend is None:
+                backend = _backends[shard] = create_backend(shard=shard)
+    return backend
@@ -1,6 +1,35 @@
+import BaseHTTPServer
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
-from game import GameState, Game, Die
+os.environ.setdefault('FISLACKO_SETTINGS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_settings.cfg'))
+
+from game import GameState, Game, Die, DicePool, VersionConflict
+from coalesce import Coalescer
+from deferred import DeferredResponder
+from grammar import Params, tokenize
+import application
+import commands
+import images
+import loadtest
+import maintenance
+import metrics
+import migrate
+import odds
+import storage
+from ratelimit import RateLimiter
+
+def unstamped(document):
+    """ The document without the _last_active time every save adds (KeyError if missing) """
+    document.pop('_last_active')
+    return document
 
 class GameStateTests(unittest.TestCase):
     def test_get(self):
@@ -17,6 +46,80 @@ class GameStateTests(unittest.TestCase):
         mf.delete('a','b')
         self.assertEquals(mf.data, {'a': {}})
 
+    def test_changes(self):
+        mf = GameState(backend=storage.MemoryBackend())
+        mf.put('game/users','u1',{'name': 'A'})
+        self.assertEquals({'game': True}, mf.changes) # Parent was created, so it is written whole
+        mf.save('C1')
+        mf.put('game/users/u1','dice',[])
+        mf.put('game/users/u1','dice',[{'c': 'white', 'n': 1}])
+        mf.delete('game','setup') # Not present, so nothing to unset
+        mf.delete('game/users','u2')
+        self.assertEquals({'game.users.u1.dice': True}, mf.changes)
+        mf.put('game','users',{})
+        mf.delete('game','users')
+        self.assertEquals({'game.users': False}, mf.changes)
+
+    def test_save_partial(self):
+        backend = storage.MemoryBackend()
+        backend.save('C1', {'_id': 'C1', 'users': {'u1': {'name': 'A'}, 'u2': {'name': 'B'}}, 'setup': ['x']}, 0)
+        first, second = GameState(backend=backend), GameState(backend=backend)
+        first.load('C1')
+        second.load('C1')
+        first.put('users/u1','dice',[{'c': 'white', 'n': 1}])
+        second.delete('','setup')
+        first.save('C1')
+        self.assertRaises(VersionConflict, second.save, 'C1')
+        second.load('C1')
+        second.delete('','setup')
+        second.save('C1')
+        self.assertEquals({'_id': 'C1', '_version': 3, 'users': {'u1': {'name': 'A', 'dice': [{'c': 'white', 'n': 1}]}, 'u2': {'name': 'B'}}},
+                          unstamped(backend.load('C1')))
+
+    def test_save_unchanged(self):
+        backend = storage.MemoryBackend()
+        mf = GameState(backend=backend)
+        mf.load('C1')
+        self.assertEquals(None, mf.get('','dice'))
+        mf.save('C1')
+        self.assertEquals(None, backend.load('C1'))
+
+    def test_event(self):
+        backend = storage.MemoryBackend()
+        backend.save('C1', {'users': {'u1': {'name': 'A', 'dice': [1]}}}, 0)
+        mf = GameState(backend=backend)
+        mf.load('C1')
+        mf.put('users/u1','dice',[2])
+        mf.put('users','u2',{'name': 'B'})
+        mf.put('users','u1',{'name': 'A2'}) # Inside users, so keeps the original dice
+        mf.put('game/dice','white',[1])
+        event = {'command': 'test'}
+        mf.save('C1', event)
+        unstamped(event['sets'])
+        self.assertEquals({'command': 'test', 'version': 2,
+                           'sets': {'users.u1': {'name': 'A2'}, 'users.u2': {'name': 'B'}, 'game': {'dice': {'white': [1]}}},
+                           'unsets': [],
+                           'before': {'users.u1': {'name': 'A', 'dice': [1]}},
+                           'missing': ['users.u2', 'game']}, dict(event, missing=sorted(event['missing'], reverse=True)))
+        self.assertEquals([event['version']], [e['version'] for e in backend.events('C1')])
+
+    def test_event_ancestor(self):
+        mf = GameState({'users': {'u1': {'dice': [1], 'name': 'A'}}}, backend=storage.MemoryBackend())
+        mf.save('C1')
+        mf.put('users/u1','dice',[2])
+        mf.delete('users','u1')
+        mf.delete('','users')
+        self.assertEquals({'users': {'u1': {'dice': [1], 'name': 'A'}}}, mf.before)
+
+    def test_load_legacy_root(self):
+        backend = storage.MemoryBackend()
+        backend.save('C1', {'_id': 'C1', '': {'dice': [{'c': 'black', 'n': 2}]}}, 0)
+        mf = GameState(backend=backend)
+        mf.load('C1')
+        self.assertEquals([{'c': 'black', 'n': 2}], mf.get('','dice'))
+        mf.save('C1')
+        self.assertEquals({'_id': 'C1', '_version': 2, 'dice': [{'c': 'black', 'n': 2}]}, unstamped(backend.load('C1')))
+
 class DieTests(unittest.TestCase):
     def test_default(self):
         self.assertEquals( u':d6-5:',Die(color='white',number=5).to_emoji())
@@ -25,12 +128,10 @@ class DieTests(unittest.TestCase):
     def test_json(self):
         self.assertEquals(u':d6-3-black:', Die(json={'c':'black','n':'3'}).to_emoji())
     
-    def test_roll(self):
+    def test_short_color(self):
         die = Die(color='w',number=1)
         self.assertEquals('white',die.color)
         self.assertEquals(1, die.number)
-        new_number = die.roll()
-        self.assertEquals(die.number,new_number)
 
     def test_params(self):
         self.assertEquals(u':d6-1:', Die(params=['w1']).to_emoji())
@@ -44,6 +145,59 @@ class DieTests(unittest.TestCase):
     def test_unicode(self):
         self.assertEquals(u'black 2', unicode(Die(params=['b2'])))
 
+    def test_equality(self):
+        self.assertEquals(Die(params=['b2']), Die(color='black', number=2))
+        self.assertNotEquals(Die(params=['b2']), Die(params=['w2']))
+        self.assertEquals(1, len(set([Die(params=['w4']), Die(json={'c': 'white', 'n': 4})])))
+
+class GrammarTests(unittest.TestCase):
+    def test_tokenize(self):
+        self.assertEquals(['give', 'w5', '@bob'], tokenize('  give  w5\t@bob '))
+
+    def test_die(self):
+        for words in (['w5'], ['White', '5'], ['white5'], ['W', '5']):
+            self.assertEquals(Die(params=['w5']), Params(words).die)
+        for words in ([], ['w7'], ['w5', 'b1'], ['white'], ['purple', '5']):
+            self.assertEquals(None, Params(words).die)
+
+    def test_dice(self):
+        self.assertEquals([Die(params=['w5']), Die(params=['b1']), Die(params=['w2'])],
+                          Params(['w5', 'black', '1', 'foo', 'white', '2']).dice)
+
+    def test_target(self):
+        params = Params(['black', '2', '@Bob'])
+        self.assertEquals('Bob', params.target)
+        self.assertEquals(Die(params=['b2']), params.target_die)
+        self.assertEquals(None, params.die)
+        self.assertEquals(None, Params(['b2']).target_die)
+        self.assertEquals(None, Params(['b2', 'w1', 'bob']).target_die)
+        self.assertEquals('black 2 @Bob', params.text)
+
+class DicePoolTests(unittest.TestCase):
+    def test_add_remove(self):
+        pool = DicePool([Die(params=['w1']), Die(params=['w1']), Die(params=['b6'])])
+        self.assertEquals(3, len(pool))
+        self.assertTrue(pool.remove(Die(params=['w1'])))
+        self.assertFalse(pool.remove(Die(params=['b5'])))
+        self.assertEquals({'white': [1,0,0,0,0,0], 'black': [0,0,0,0,0,1]}, pool.to_json())
+        self.assertEquals([Die(params=['w1']), Die(params=['b6'])], list(pool))
+        self.assertEquals(1, pool.count('black'))
+
+    def test_from_json(self):
+        self.assertEquals(0, len(DicePool.from_json(None)))
+        self.assertEquals({'white': [0,0,0,0,1,0], 'black': [0,0,2,0,0,0]},
+                          DicePool.from_json([{'c': 'black', 'n': 3}, {'c': 'white', 'n': 5}, {'c': 'black', 'n': 3}]).to_json())
+        self.assertEquals({'white': [0,0,0,0,1,0], 'black': [0]*6},
+                          DicePool.from_json({'white': [0,0,0,0,1,0]}).to_json())
+
+    def test_rolled(self):
+        pool = DicePool.rolled(300, 2)
+        self.assertEquals((300, 2), (pool.count('white'), pool.count('black')))
+        self.assertTrue(all(pool.counts['white'])) # Every face comes up
+        pool.remove(list(pool)[0])
+        pool.reroll()
+        self.assertEquals((299, 2), (pool.count('white'), pool.count('black')))
+
 class GameTests(unittest.TestCase):
     def setUp(self):
         self.game = Game(GameState({'game': {'users':{'12456': {'name': 'Test', 'slack_name': 'Bar'}}}}),'game')
@@ -66,16 +220,27 @@ class GameTests(unittest.TestCase):
         self.assertEquals(None,self.game.get_user_id_for_slack_name('foo'))
         self.assertEquals(u'12456', self.game.get_user_id_for_slack_name('bar'))
         
+    def test_slack_name_index(self):
+        self.game.set_user('u2', 'First.Last', 'Test 2')
+        self.assertEquals({'bar': '12456', 'first%2Elast': 'u2'}, self.game.game_state.get('game','slack_names'))
+        self.assertEquals('u2', self.game.get_user_id_for_slack_name('first.last'))
+        self.game.set_user('u2', 'renamed', 'Test 2')
+        self.assertEquals(None, self.game.get_user_id_for_slack_name('first.last'))
+        self.game.unregister('12456')
+        self.assertEquals({'renamed': 'u2'}, self.game.game_state.get('game','slack_names'))
+        self.game.clear()
+        self.assertEquals(None, self.game.get_user_id_for_slack_name('renamed'))
+
     def test_take_die_from(self):
         self.game.set_user_dice('12456',[Die(params=['b1'])])
         self.assertTrue(self.game.take_die_from(Die(params=['b1']),'12456'))
         self.assertFalse(self.game.take_die_from(Die(params=['b1']),'12456none'))
         self.assertFalse(self.game.take_die_from(Die(params=['w1']),'12456'))
-        self.assertEquals({'game': {'users':{'12456': {'name': 'Test', 'slack_name': 'Bar', 'dice':[]}}}}, self.game.game_state.data)
+        self.assertEquals({'game': {'users':{'12456': {'name': 'Test', 'slack_name': 'Bar', 'dice': {'white': [0]*6, 'black': [0]*6}}}}}, self.game.game_state.data)
 
     def test_give_die_to(self):
         self.assertTrue(self.game.give_die_to(Die(params=['b1']),'12456'))
-        self.assertEquals({'game': {'users':{'12456': {'dice':[{'c': 'black', 'n': 1}],'name': 'Test', 'slack_name': 'Bar'}}}}, self.game.game_state.data)
+        self.assertEquals({'game': {'users':{'12456': {'dice': {'white': [0]*6, 'black': [1,0,0,0,0,0]},'name': 'Test', 'slack_name': 'Bar'}}}}, self.game.game_state.data)
 
     def test_get_user(self):
         self.assertEquals({'name': 'Test', 'slack_name': 'Bar'}, self.game.get_user('12456'))
@@ -99,6 +264,11 @@ class GameTests(unittest.TestCase):
         self.game.unregister('12456')
         self.assertEquals({}, self.game.users)
 
+    def test_legacy_dice(self):
+        self.game.game_state.put('game','dice',[{'c': 'white', 'n': 2}, {'c': 'black', 'n': 4}])
+        self.assertTrue(self.game.take_die_from_pool(Die(params=['b4'])))
+        self.assertEquals({'white': [0,1,0,0,0,0], 'black': [0]*6}, self.game.game_state.get('game','dice'))
+
     def test_user_dice(self):
         self.assertEquals([], self.game.get_user_dice('12456'))
         self.game.set_user_dice('12456', [Die(number=5,color='w')])
@@ -110,6 +280,828 @@ class GameTests(unittest.TestCase):
         self.game.clear()
         self.assertEquals({'game': {}}, self.game.game_state.data)
     
+class OddsTests(unittest.TestCase):
+    def test_sum_distribution(self):
+        self.assertEquals([1.0], odds.sum_distribution(0))
+        self.assertEquals([0,1/6.0,1/6.0,1/6.0,1/6.0,1/6.0,1/6.0], odds.sum_distribution(1))
+        self.assertAlmostEquals(1.0, sum(odds.sum_distribution(2)))
+        self.assertAlmostEquals(6/36.0, odds.sum_distribution(2)[7])
+        self.assertAlmostEquals(1.0, sum(odds.sum_distribution(odds.MAX_DICE)))
+        self.assertEquals(odds.TABLE_SIZE+1, len(odds._sums)) # Larger counts are not kept
+        self.assertRaises(ValueError, odds.sum_distribution, odds.MAX_DICE+1)
+
+    def test_outcome_odds(self):
+        one = odds.outcome_odds(1, 0)
+        for key, value in {'white': 1.0, 'black': 0.0, 'zero': 0.0, 'white_average': 3.5, 'black_average': 0}.items():
+            self.assertAlmostEquals(value, one[key])
+        even = odds.outcome_odds(1, 1)
+        self.assertAlmostEquals(6/36.0, even['zero'])
+        self.assertAlmostEquals(even['white'], even['black'])
+        big = odds.outcome_odds(30, 29)
+        self.assertAlmostEquals(1.0, big['white'] + big['black'] + big['zero'])
+        self.assertTrue(big['white'] > big['black'])
+
+    def test_commands(self):
+        game = Game(GameState({}), 'game')
+        self.assertEquals('You have no dice.', commands.odds(game, [], 'u1', 'ann').text)
+        game.set_user_dice('u1', [Die(params=['w1']), Die(params=['b2'])])
+        self.assertTrue(commands.odds(game, [], 'u1', 'ann').text.startswith('1 white and 1 black: white 41.7%'))
+        self.assertTrue(commands.odds(game, ['2', '0'], 'u1', 'ann').text.startswith('2 white and 0 black: white 100.0% (average 7.0)'))
+        for counts in (['250', '250'], ['1000', '0'], ['-1', '2'], ['5'], ['1', '2', '3']):
+            self.assertTrue(commands.odds(game, counts, 'u1', 'ann').text.startswith('Usage: /fiasco odds'))
+        text = commands.roll(game, [], 'u1', 'ann').text
+        self.assertEquals(2, len(game.get_user_dice('u1')))
+        self.assertTrue(text.startswith('ann rolled'))
+        faces = [int(n) * (-1 if black else 1) for n, black in re.findall(r':d6-(\d)(-black)?:', text)]
+        self.assertEquals(2, len(faces))
+        total = sum(faces)
+        self.assertTrue(text.endswith('white %d' % total if total > 0 else 'black %d' % -total if total else '0.'))
+
+class StorageTests(unittest.TestCase):
+    def tearDown(self):
+        storage.configure(dict(storage.DEFAULTS, STORAGE_BACKEND='memory'))
+
+    def test_client_shared(self):
+        self.assertTrue(storage.get_client() is storage.get_client())
+
+    def test_client_after_fork(self):
+        client = storage.get_client()
+        storage._client_pid = -1 # As seen from a forked worker
+        self.assertFalse(client is storage.get_client())
+
+    def test_configure(self):
+        client = storage.get_client()
+        storage.configure({'MONGO_DATABASE': 'fislacko_test', 'MONGO_MAX_POOL_SIZE': 3})
+        self.assertEquals('fislacko_test', storage.games().database.name)
+        self.assertFalse(client is storage.get_client())
+
+    def test_mongo_event_keys(self):
+        import bson
+        event = {'version': 1, 'sets': {'users.U1.dice': 1}, 'unsets': [], 'before': {}, 'missing': []}
+        stored = storage.MongoBackend().stored_event('C1', event)
+        self.assertEquals([['users.U1.dice', 1]], stored['sets'])
+        bson.BSON.encode(stored, check_keys=True) # Raises InvalidDocument for dotted keys
+
+class BackendTestsMixin(object):
+    def test_load_missing(self):
+        self.assertEquals(None, self.backend.load('nosuchgame'))
+
+    def test_round_trip(self):
+        gs = GameState({'game': {'dice': [{'c': 'white', 'n': 3}]}}, backend=self.backend)
+        gs.save('C1')
+        loaded = GameState(backend=self.backend)
+        loaded.load('C1')
+        self.assertEquals({'_id': 'C1', '_version': 1, 'game': {'dice': [{'c': 'white', 'n': 3}]}}, unstamped(loaded.data))
+
+    def test_update(self):
+        self.backend.save('C1', {'_id': 'C1', 'a': {'b': 1, 'c': 2}}, 0)
+        self.backend.update('C1', {'a.d.e': [1]}, ['a.b', 'x.y'], 1)
+        self.assertEquals({'_id': 'C1', '_version': 2, 'a': {'c': 2, 'd': {'e': [1]}}}, self.backend.load('C1'))
+        self.backend.update('C2', {'a': 1}, [], 0)
+        self.assertEquals({'_id': 'C2', '_version': 1, 'a': 1}, self.backend.load('C2'))
+
+    def test_version_conflict(self):
+        self.backend.save('C1', {'a': 1}, 0)
+        self.assertRaises(VersionConflict, self.backend.save, 'C1', {'a': 2}, 0)
+        self.assertRaises(VersionConflict, self.backend.update, 'C1', {'a': 2}, [], 2)
+        self.assertRaises(VersionConflict, self.backend.update, 'C2', {'a': 2}, [], 1)
+        self.assertEquals({'a': 1, '_version': 1}, self.backend.load('C1'))
+
+    def test_save_replaces(self):
+        self.backend.save('C1', {'a': 1}, 0)
+        self.backend.save('C1', {'b': 2}, 1)
+        self.assertEquals({'b': 2, '_version': 2}, self.backend.load('C1'))
+
+    def test_events(self):
+        for version in (1, 2, 3):
+            self.backend.append_event('C1', {'version': version, 'command': 'take w%d' % version})
+        self.backend.append_event('C2', {'version': 1})
+        self.assertEquals([3, 2, 1], [e['version'] for e in self.backend.events('C1')])
+        self.assertEquals([3, 2], [e['version'] for e in self.backend.events('C1', limit=2)])
+        self.assertEquals([{'version': 3, 'command': 'take w3'}], self.backend.events('C1', after=2))
+
+    def test_event_field_names(self):
+        event = {'version': 1, 'sets': {'users.U1.dice': {'white': 2}, 'slack_names.bob': 'U1'},
+                 'unsets': ['users.U2'], 'before': {'users.U1.dice': {}}, 'missing': ['slack_names.bob']}
+        self.backend.append_event('C1', event)
+        self.assertEquals([event], self.backend.events('C1'))
+
+    def test_snapshots(self):
+        self.assertEquals(None, self.backend.load_snapshot('C1'))
+        self.backend.save_snapshot('C1', 5, {'a': 5})
+        self.backend.save_snapshot('C1', 10, {'a': 10})
+        self.assertEquals((10, {'a': 10}), self.backend.load_snapshot('C1'))
+        self.assertEquals((5, {'a': 5}), self.backend.load_snapshot('C1', 9))
+        self.assertEquals(None, self.backend.load_snapshot('C1', 4))
+
+    def test_insert_and_delete(self):
+        self.backend.insert('C1', {'a': 1, '_version': 7})
+        self.assertRaises(VersionConflict, self.backend.insert, 'C1', {'a': 2})
+        self.assertEquals({'_id': 'C1', 'a': 1, '_version': 7}, self.backend.load('C1'))
+        self.backend.append_event('C1', {'version': 7})
+        self.backend.save_snapshot('C1', 7, {'a': 1})
+        self.backend.save('C2', {}, 0)
+        self.assertEquals(['C1', 'C2'], sorted(self.backend.game_ids()))
+        self.backend.delete('C1')
+        self.assertEquals((None, [], None), (self.backend.load('C1'), self.backend.events('C1'), self.backend.load_snapshot('C1')))
+        self.assertEquals(['C2'], self.backend.game_ids())
+        self.assertRaises(VersionConflict, self.backend.delete, 'C2', 2)
+        self.backend.delete('C2', 1)
+        self.assertEquals([], self.backend.game_ids())
+
+    def test_archive(self):
+        self.assertEquals(None, self.backend.load_archive('C1'))
+        self.backend.save_archive('C1', '\x00\xffcompressed')
+        self.assertEquals('\x00\xffcompressed', self.backend.load_archive('C1'))
+        self.assertEquals(['C1'], self.backend.archived_ids())
+        self.backend.delete_archive('C1')
+        self.assertEquals((None, []), (self.backend.load_archive('C1'), self.backend.archived_ids()))
+
+def mongo_reachable(_reachable=[]):
+    if not _reachable:
+        import pymongo
+        try:
+            pymongo.MongoClient(storage.DEFAULTS['MONGO_URI'], serverSelectionTimeoutMS=500).admin.command('ping')
+            _reachable.append(True)
+        except pymongo.errors.PyMongoError:
+            _reachable.append(False)
+    return _reachable[0]
+
+class MongoBackendTests(BackendTestsMixin, unittest.TestCase):
+    def setUp(self):
+        if not mongo_reachable():
+            self.skipTest('no mongod at %s' % storage.DEFAULTS['MONGO_URI'])
+        self.backend = storage.MongoBackend('fislacko_test', 'backend_tests_')
+        self.tearDown()
+
+    def tearDown(self):
+        for name in ('games', 'events', 'snapshots', 'archive'):
+            self.backend.collection(name).drop()
+
+class MemoryBackendTests(BackendTestsMixin, unittest.TestCase):
+    def setUp(self):
+        self.backend = storage.MemoryBackend()
+
+    def test_copies(self):
+        data = {'a': {'b': 1}}
+        self.backend.save('C1', data, 0)
+        data['a']['b'] = 2
+        self.assertEquals({'a': {'b': 1}, '_version': 1}, self.backend.load('C1'))
+
+class SQLiteBackendTests(BackendTestsMixin, unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.backend = storage.SQLiteBackend(os.path.join(self.dir, 'test.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_wal(self):
+        self.assertEquals('wal', self.backend.connection().execute('PRAGMA journal_mode').fetchone()[0])
+
+class CachedBackendTests(BackendTestsMixin, unittest.TestCase):
+    def setUp(self):
+        self.store = storage.MemoryBackend()
+        self.backend = storage.CachedBackend(self.store, 2, 60)
+        self.now = 1000
+        self.backend.clock = lambda: self.now
+
+    def test_hits(self):
+        self.backend.save('C1', {'a': 1}, 0)
+        self.assertEquals({'a': 1, '_version': 1}, self.backend.load('C1'))
+        self.backend.update('C1', {'b': 2}, [], 1)
+        self.assertEquals({'a': 1, 'b': 2, '_version': 2}, self.backend.load('C1'))
+        self.assertEquals(None, self.backend.load('C2'))
+        self.assertEquals({'size': 1, 'hits': 2, 'misses': 1, 'evictions': 0, 'invalidations': 0}, self.backend.stats())
+
+    def test_changed_elsewhere(self):
+        self.backend.save('C1', {'a': 1}, 0)
+        self.store.update('C1', {'a': 2}, [], 1) # Another worker
+        self.assertEquals({'a': 2, '_version': 2}, self.backend.load('C1'))
+        self.assertRaises(VersionConflict, self.backend.update, 'C1', {'a': 3}, [], 1)
+        self.assertEquals(1, self.backend.stats()['misses'])
+        self.assertEquals(2, self.backend.stats()['invalidations'])
+
+    def test_eviction(self):
+        for game_id in ('C1', 'C2', 'C3'):
+            self.backend.save(game_id, {}, 0)
+        self.assertEquals(['C2', 'C3'], list(self.backend.entries))
+        self.now += 61
+        self.backend.load('C2')
+        self.assertEquals({'size': 2, 'hits': 0, 'misses': 1, 'evictions': 2, 'invalidations': 0}, self.backend.stats())
+
+class RouteTests(unittest.TestCase):
+    def setUp(self):
+        storage.configure({'STORAGE_BACKEND': 'memory'})
+        application.route('R1', ['register', 'Ann'], 'u1', 'ann')
+        game_state = GameState()
+        game_state.load('R1')
+        Game(game_state).dice = [Die(params=['w5']), Die(params=['b2'])]
+        game_state.save('R1')
+
+    def hand(self):
+        game_state = GameState()
+        game_state.load('R1')
+        return Game(game_state).get_user_dice('u1')
+
+    def test_parse_steps(self):
+        def parse(data):
+            return [(step.name, list(step.params)) for step in application.parse_steps(data)]
+        self.assertEquals([('take', ['w5'])], parse(['Take', '', 'w5']))
+        self.assertEquals([('take', ['w5']), ('take', ['b', '2']), ('roll', [])],
+                          parse('take w5; take b 2 ;roll;'.split(' ')))
+        self.assertEquals([], parse([]))
+        self.assertEquals([('setup', ['add', 'Lies;', 'old', 'debts']), ('status', [])],
+                          parse('setup add Lies; old debts; status'.split(' ')))
+        self.assertEquals([('register', ['Sam;', 'the', 'Hammer'])], parse('register Sam; the Hammer'.split(' ')))
+        self.assertTrue(application.parse_steps(['take', 'w5']) is application.parse_steps(['take', 'w5'])) # Cached
+
+    def test_batch(self):
+        response = application.route('R1', 'take w5; take b2; status'.split(' '), 'u1', 'ann')
+        self.assertEquals('in_channel', response['response_type'])
+        self.assertTrue(response['text'].startswith('ann claimed :d6-5:.'))
+        self.assertTrue('ann claimed :d6-2-black:.' in response['text'])
+        self.assertTrue('Ann (ann) :d6-5: :d6-2-black:' in response['text'])
+        self.assertEquals([Die(params=['w5']), Die(params=['b2'])], self.hand())
+
+    def test_batch_failure(self):
+        response = application.route('R1', 'take w5; take w6'.split(' '), 'u1', 'ann')
+        self.assertEquals('Nothing was done because "take w6" failed: Could not find a white 6', response['text'])
+        self.assertEquals([], self.hand())
+
+    def test_batch_unknown_command(self):
+        self.assertTrue(application.route('R1', 'dance; take w5'.split(' '), 'u1', 'ann')['text'].startswith('Usage'))
+        self.assertEquals('Format is w5 or white 5 (or b1 or black 1',
+                          application.route('R1', 'take w5; dance'.split(' '), 'u1', 'ann')['text'])
+        self.assertEquals([], self.hand())
+
+    def test_setup_with_semicolon(self):
+        application.route('R1', 'setup add Lies; old debts'.split(' '), 'u1', 'ann')
+        self.assertTrue('Lies; old debts' in application.route('R1', ['setup'], 'u1', 'ann')['text'])
+
+class TenantTests(unittest.TestCase):
+    def setUp(self):
+        storage.configure({'STORAGE_BACKEND': 'memory', 'SHARDS': {'big': {}}, 'TEAM_SHARDS': {'T2': 'big'}})
+
+    def tearDown(self):
+        storage.configure({'SHARDS': {}, 'TEAM_SHARDS': {}, 'SHARD_ROUTER': None})
+        application.team_limiter = None
+
+    def test_game_key(self):
+        self.assertEquals('T1:C1', storage.game_key('T1', 'C1'))
+        self.assertEquals('C1', storage.game_key(None, 'C1'))
+
+    def test_shards(self):
+        self.assertTrue(storage.get_backend('T1') is storage.get_backend())
+        self.assertTrue(storage.get_backend('T2') is storage.get_backend('T2'))
+        self.assertFalse(storage.get_backend('T2') is storage.get_backend())
+        storage.configure({'SHARD_ROUTER': lambda team_id: 'big' if team_id.startswith('E') else None})
+        self.assertTrue(storage.get_backend('E1') is storage.get_backend('E2'))
+        self.assertFalse(storage.get_backend('E1') is storage.get_backend('T2'))
+
+    def test_route(self):
+        application.route('C1', ['register', 'Ann'], 'u1', 'ann', 'T1')
+        application.route('C1', ['register', 'Bob'], 'u2', 'bob', 'T2')
+        self.assertEquals(['u1'], list(storage.get_backend('T1').load('T1:C1')['users']))
+        self.assertEquals(['u2'], list(storage.get_backend('T2').load('T2:C1')['users']))
+        self.assertEquals(None, storage.get_backend('T2').load('T1:C1'))
+        self.assertEquals(None, storage.get_backend().load('C1'))
+
+    def test_migrate(self):
+        application.route('C1', ['register', 'Ann'], 'u1', 'ann')
+        application.route('C1', ['register', 'Bob'], 'u2', 'bob')
+        application.route('C2', ['register', 'Cat'], 'u3', 'cat')
+        source, target = storage.get_backend(), storage.get_backend('T2')
+        target.save('T2:C2', {'users': {'u4': {'name': 'Dan'}}}, 0) # Started under the new key
+        self.assertEquals((['C1'], ['C2']), migrate.migrate('T2', source, target, dry_run=True))
+        self.assertEquals(['C1', 'C2'], sorted(source.game_ids()))
+        self.assertEquals((['C1'], ['C2']), migrate.migrate('T2', source, target))
+        self.assertEquals(['C2'], source.game_ids())
+        self.assertEquals(2, target.load('T2:C1')['_version'])
+        self.assertEquals('1) ann: register Ann\n2) bob: register Bob', application.route('C1', ['history'], 'u1', 'ann', 'T2')['text'])
+        application.route('C1', ['undo'], 'u1', 'ann', 'T2')
+        self.assertEquals(['u1'], list(target.load('T2:C1')['users']))
+
+    def test_unkeyed_moved_on_first_use(self):
+        application.route('C1', ['register', 'Ann'], 'u1', 'ann')
+        application.route('C2', ['register', 'Cat'], 'u3', 'cat')
+        storage.archive(storage.get_backend(), 'C2', time.time() + 1)
+        application.route('C1', ['register', 'Bob'], 'u2', 'bob', 'T2')
+        target = storage.get_backend('T2')
+        self.assertEquals(['u1', 'u2'], sorted(target.load('T2:C1')['users']))
+        self.assertEquals([], storage.get_backend().game_ids())
+        self.assertEquals('1) ann: register Ann\n2) bob: register Bob', application.route('C1', ['history'], 'u1', 'ann', 'T2')['text'])
+        self.assertEquals('1) cat: register Cat', application.route('C2', ['history'], 'u1', 'ann', 'T2')['text'])
+        self.assertEquals([], storage.get_backend().archived_ids())
+        self.assertEquals(None, storage.restore_unkeyed(target, 'T2:C3'))
+
+    def test_unversioned_unkeyed(self):
+        source = storage.get_backend()
+        for channel_id in ('C1', 'C2'): # As saved before versions or workspaces were kept
+            source.documents[channel_id] = {'_id': channel_id, '': {'users': {'u1': {'name': 'Ann', 'slack_name': 'ann'}}}}
+        self.assertTrue('Ann' in application.route('C1', ['status'], 'u1', 'ann', 'T1')['text'])
+        self.assertEquals('No history yet.', application.route('C2', ['history'], 'u1', 'ann', 'T1')['text'])
+        self.assertEquals(['T1:C1', 'T1:C2'], sorted(storage.get_backend('T1').game_ids()))
+        self.assertEquals(([], []), migrate.migrate('T1', source, storage.get_backend('T1')))
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(2, 3)
+        now = [1000]
+        limiter.clock = lambda: now[0]
+        self.assertEquals([True, True, True, False], [limiter.allow('T1') for i in range(4)])
+        self.assertTrue(limiter.allow('T2'))
+        now[0] += 0.5
+        self.assertEquals([True, False], [limiter.allow('T1') for i in range(2)])
+
+    def test_team_rate_limit(self):
+        application.team_limiter = RateLimiter(1, 1)
+        refused = metrics.RATE_LIMITED.get(limit='team')
+        post = lambda team_id: json.loads(application.app.test_client().post('/fiasco/', data={
+            'text': 'status', 'channel_id': 'C1', 'team_id': team_id, 'user_id': 'u1', 'user_name': 'ann'}).data)['text']
+        self.assertFalse('too many' in post('T1'))
+        self.assertTrue('too many' in post('T1'))
+        self.assertFalse('too many' in post('T2'))
+        self.assertEquals(refused + 1, metrics.RATE_LIMITED.get(limit='team'))
+
+class ArchiveTests(unittest.TestCase):
+    def setUp(self):
+        storage.configure({'STORAGE_BACKEND': 'memory', 'SNAPSHOT_INTERVAL': 2})
+        self.backend = storage.get_backend()
+        application.route('A1', ['register', 'Ann'], 'u1', 'ann')
+        application.route('A1', 'setup add A bowling alley'.split(' '), 'u1', 'ann')
+        application.route('A2', ['register', 'Bob'], 'u2', 'bob')
+
+    def tearDown(self):
+        storage.configure({'SNAPSHOT_INTERVAL': storage.DEFAULTS['SNAPSHOT_INTERVAL']})
+
+    def test_last_active(self):
+        document = self.backend.load('A1')
+        self.assertTrue(abs(document['_last_active'] - time.time()) < 5)
+        self.backend.save('A3', {}, 0)
+        self.assertEquals(0, storage.last_active(self.backend, 'A3', self.backend.load('A3')))
+        self.backend.append_event('A3', {'version': 1, 'time': 123})
+        self.assertEquals(123, storage.last_active(self.backend, 'A3', self.backend.load('A3')))
+
+    def test_archive_and_restore(self):
+        live = self.backend.load('A1')
+        self.assertEquals(None, storage.archive(self.backend, 'A1', live['_last_active']))
+        self.assertTrue(storage.archive(self.backend, 'A1', time.time() + 1) > 0)
+        self.assertEquals((None, [], None), (self.backend.load('A1'), self.backend.events('A1'), self.backend.load_snapshot('A1')))
+        self.assertEquals(['A1'], self.backend.archived_ids())
+        game_state = GameState()
+        game_state.load('A1')
+        self.assertEquals(live, game_state.data)
+        self.assertEquals([], self.backend.archived_ids())
+        self.assertEquals(2, self.backend.load_snapshot('A1')[0])
+        self.assertTrue('Ann' in application.route('A1', ['status'], 'u1', 'ann')['text'])
+
+    def test_log_commands_restore(self):
+        storage.archive(self.backend, 'A1', time.time() + 1)
+        self.assertEquals('1) ann: register Ann\n2) ann: setup add A bowling alley',
+                          application.route('A1', ['history'], 'u1', 'ann')['text'])
+        self.assertEquals(2, self.backend.version('A1'))
+
+    def test_changed_while_archiving(self):
+        original = self.backend.save_archive
+        def save_archive(game_id, data):
+            original(game_id, data)
+            application.route('A1', ['register', 'Ann2'], 'u1', 'ann') # Another worker
+        self.backend.save_archive = save_archive
+        self.assertEquals(None, storage.archive(self.backend, 'A1', time.time() + 1))
+        self.assertEquals([], self.backend.archived_ids())
+        self.assertEquals(3, self.backend.version('A1'))
+
+    def test_maintenance(self):
+        self.assertEquals(['A1', 'A2'], sorted(maintenance.archive_idle(self.backend, time.time() + 1, dry_run=True)))
+        report = maintenance.working_set(self.backend, time.time() + 1)
+        self.assertEquals((2, 2, 0), (report['games'], report['idle'], report['archived']))
+        self.assertEquals([], maintenance.archive_idle(self.backend, time.time() - 60))
+        self.assertEquals(['A1', 'A2'], sorted(maintenance.archive_idle(self.backend, time.time() + 1)))
+        report = maintenance.working_set(self.backend, time.time() + 1)
+        self.assertEquals((0, 0, 2), (report['games'], report['idle'], report['archived']))
+        self.assertTrue(report['archived_bytes'] > 0)
+        self.assertEquals([None], maintenance.shards())
+
+class TablesTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = storage.MemoryBackend()
+        game_state = GameState(backend=self.backend)
+        game = Game(game_state)
+        game.set_user('u1', 'ann', 'Ann')
+        for name, players in (('t1', 3), ('t2', 0), ('t3', 1)):
+            game_state.put('tables', name, {})
+            for i in range(players):
+                Game(game_state, 'tables/%s' % name).set_user('u%d' % i, 'p%d' % i, 'P%d' % i)
+        game_state.save('T1')
+
+    def load(self):
+        game_state = GameState(backend=self.backend)
+        game_state.load('T1')
+        return Game(game_state)
+
+    def test_reset_all(self):
+        game = self.load()
+        updates = []
+        original = self.backend.update
+        self.backend.update = lambda *args: updates.append(args) or original(*args)
+        response = commands.pool(game, Params(['reset', 'all']), 'u1', 'ann')
+        self.assertEquals(['Channel', 't1', 't3'], [line.split(':')[0] for line in response.text.split('\n')])
+        game.game_state.save('T1')
+        self.assertEquals(1, len(updates))
+        game = self.load()
+        tables = dict(game.tables())
+        self.assertEquals([2, 6, 0, 2], [g.pool.count('white') for g in (game, tables['t1'], tables['t2'], tables['t3'])])
+        self.assertEquals(6, tables['t1'].pool.count('black'))
+
+    def test_reroll_all(self):
+        game = self.load()
+        commands.pool(game, Params(['reset', 'all']), 'u1', 'ann')
+        commands.pool(game, Params(['reroll', 'all']), 'u1', 'ann')
+        self.assertEquals([4, 12, 0, 4], [g.pool.count() for g in [game] + [g for name, g in game.tables()]])
+
+    def test_reset_one(self):
+        game = self.load()
+        response = commands.pool(game, Params(['reset']), 'u1', 'ann')
+        self.assertEquals(4, len(response.text.split(' ')))
+        self.assertEquals(None, game.tables()[0][1].game_state.get('tables/t1', 'dice'))
+
+class HotChannelTests(unittest.TestCase):
+    def setUp(self):
+        storage.configure({'STORAGE_BACKEND': 'memory'})
+        application.route('H1', ['register', 'Ann'], 'u1', 'ann')
+
+    def tearDown(self):
+        application.channel_limiter = None
+
+    def test_coalescer(self):
+        coalescer = Coalescer()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return len(calls)
+        leader = threading.Thread(target=lambda: results.append(coalescer.run('k', work)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(coalescer.run('k', work))) for i in range(3)]
+        for thread in followers:
+            thread.start()
+        while coalescer.calls['k'].waiters < 3:
+            time.sleep(0.001)
+        self.assertEquals(('other', False), coalescer.run('other', lambda: 'other'))
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEquals([(1, False), (1, True), (1, True), (1, True)], sorted(results, key=lambda r: r[1]))
+        self.assertEquals((2, False), coalescer.run('k', work))
+
+    def test_coalescer_error(self):
+        def fail():
+            raise ValueError('boom')
+        self.assertRaises(ValueError, Coalescer().run, 'k', fail)
+
+    def test_route_coalesces_reads(self):
+        original = application.COMMAND_MAPPINGS['status']
+        started, release = threading.Event(), threading.Event()
+        def slow_status(*args):
+            started.set()
+            release.wait()
+            return original(*args)
+        application.COMMAND_MAPPINGS['status'] = slow_status
+        coalesced = metrics.COALESCED.get(command='status')
+        responses = []
+        try:
+            threads = [threading.Thread(target=lambda: responses.append(application.route('H1', ['status'], 'u1', 'ann')))
+                       for i in range(3)]
+            threads[0].start()
+            started.wait()
+            for thread in threads[1:]:
+                thread.start()
+            while application.coalescer.calls[('H1', 'status')].waiters < 2:
+                time.sleep(0.001)
+            release.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            application.COMMAND_MAPPINGS['status'] = original
+        self.assertEquals(3, len(responses))
+        self.assertTrue(all(response == responses[0] for response in responses))
+        self.assertFalse(responses[0] is responses[1])
+        self.assertEquals(coalesced + 2, metrics.COALESCED.get(command='status'))
+
+    def test_writes_not_coalesced(self):
+        keys = []
+        run = application.coalescer.run
+        application.coalescer.run = lambda key, fn: keys.append(key) or run(key, fn)
+        try:
+            application.route('H1', ['pool', 'reset'], 'u1', 'ann')
+            application.route('H1', 'pool; status'.split(' '), 'u1', 'ann')
+            self.assertEquals(4, len(application.route('H1', ['pool'], 'u1', 'ann')['text'].split(' ')))
+        finally:
+            del application.coalescer.run
+        self.assertEquals([('H1', 'pool')], keys)
+
+    def test_channel_rate_limit(self):
+        application.channel_limiter = RateLimiter(1, 2)
+        refused = metrics.RATE_LIMITED.get(limit='channel')
+        post = lambda channel_id: json.loads(application.app.test_client().post('/fiasco/', data={
+            'text': 'status', 'channel_id': channel_id, 'user_id': 'u1', 'user_name': 'ann'}).data)['text']
+        self.assertEquals([False, False, True], ['too many' in post('H1') for i in range(3)])
+        self.assertFalse('too many' in post('H2'))
+        self.assertEquals(refused + 1, metrics.RATE_LIMITED.get(limit='channel'))
+
+class ImageTests(unittest.TestCase):
+    def test_round_trip(self):
+        with open(os.path.join(images.EMOJI_DIR, 'd6-5-black.png'), 'rb') as f:
+            image = images.decode(f.read())
+        self.assertEquals((120, 120), image[:2])
+        self.assertEquals(image, images.decode(images.encode(image)))
+        self.assertEquals(image, images.decode(images.encode(image, optimize=True)))
+        small = images.resize(image, 32)
+        self.assertEquals((32, 32, 32, 128), small[:2] + (len(small[2]), len(small[2][0])))
+        self.assertTrue(images.resize(small, 64) is small)
+
+    def test_render(self):
+        hands = images.HandImages(tile=8)
+        etag, png = hands.render('w1b6w2_b1_')
+        self.assertEquals((24, 24), images.decode(png)[:2])
+        self.assertEquals((etag, png), hands.render('w1b6w2_b1_'))
+        self.assertNotEquals(etag, hands.render('w1b6w3_b1_')[0])
+        for spec in ('w7', 'x1', 'w1_b', 'w1' * (images.MAX_IMAGE_DICE + 1), '_' * images.MAX_IMAGE_ROWS,
+                     'w1' * 137 + '_w1' * 63):
+            self.assertRaises(ValueError, hands.render, spec)
+        self.assertEquals((8, 8 * images.MAX_IMAGE_ROWS), images.decode(hands.render('w1' + '_' * (images.MAX_IMAGE_ROWS - 1))[1])[:2])
+
+    def test_endpoint(self):
+        client = application.app.test_client()
+        self.assertEquals(404, client.get('/dice/w5b2_b1.png').status_code) # Images are off
+        commands.DICE_IMAGE_URL = 'https://fiasco.example.com/'
+        self.addCleanup(setattr, commands, 'DICE_IMAGE_URL', None)
+        response = client.get('/dice/w5b2_b1.png')
+        self.assertEquals((200, 'image/png'), (response.status_code, response.mimetype))
+        etag = response.headers['ETag']
+        self.assertEquals(304, client.get('/dice/w5b2_b1.png', headers={'If-None-Match': etag}).status_code)
+        self.assertEquals(404, client.get('/dice/w9.png').status_code)
+
+    def test_status_image(self):
+        storage.configure({'STORAGE_BACKEND': 'memory'})
+        application.route('I1', ['register', 'Ann'], 'u1', 'ann')
+        application.route('I1', ['pool', 'reset'], 'u1', 'ann')
+        self.assertFalse('attachments' in application.route('I1', ['status'], 'u1', 'ann'))
+        commands.DICE_IMAGE_URL = 'https://fiasco.example.com/'
+        try:
+            url = application.route('I1', ['status'], 'u1', 'ann')['attachments'][0]['image_url']
+        finally:
+            commands.DICE_IMAGE_URL = None
+        self.assertTrue(url.startswith('https://fiasco.example.com/dice/') and url.endswith('.png'))
+        hand, pool = url[len('https://fiasco.example.com/dice/'):-len('.png')].split('_')
+        self.assertEquals('', hand)
+        self.assertTrue(re.match('^(w[1-6]){2}(b[1-6]){2}$', pool))
+
+class SignatureTests(unittest.TestCase):
+    def tearDown(self):
+        application.app.config.pop('SLACK_SIGNING_SECRET', None)
+
+    def test_verify(self):
+        signed = application.signature('secret', '1000', 'text=status')
+        self.assertTrue(application.verify_signature('secret', '1000', 'text=status', signed, now=1100))
+        self.assertFalse(application.verify_signature('other', '1000', 'text=status', signed, now=1100))
+        self.assertFalse(application.verify_signature('secret', '1000', 'text=roll', signed, now=1100))
+        self.assertFalse(application.verify_signature('secret', '1000', 'text=status', signed, now=2000))
+        self.assertFalse(application.verify_signature('secret', None, 'text=status', None))
+
+    def test_router(self):
+        storage.configure({'STORAGE_BACKEND': 'memory'})
+        application.app.config['SLACK_SIGNING_SECRET'] = 'secret'
+        client = application.app.test_client()
+        body = 'text=status&channel_id=S1&user_id=u1&user_name=ann'
+        timestamp = str(int(time.time()))
+        post = lambda signed: client.post('/fiasco/', data=body, content_type='application/x-www-form-urlencoded',
+                                          headers={'X-Slack-Request-Timestamp': timestamp, 'X-Slack-Signature': signed})
+        self.assertEquals(403, post('v0=forged').status_code)
+        response = post(application.signature('secret', timestamp, body))
+        self.assertEquals(200, response.status_code)
+        self.assertTrue('No users registered' in json.loads(response.data)['text'])
+
+class LoadTestTests(unittest.TestCase):
+    def tearDown(self):
+        application.app.config.pop('SLACK_SIGNING_SECRET', None)
+
+    def test_run(self):
+        loadtest.configure_store('memory')
+        test = loadtest.LoadTest(loadtest.InProcessClient('secret'), 5, 3, 'secret', seed=1)
+        test.setup(2)
+        self.assertEquals(20, len(test.results['register']) + len(test.results['pool']))
+        test.load(4, 10000, count=300)
+        self.assertEquals(320, sum(len(timings) for timings in test.results.values()))
+        self.assertEquals({}, dict(test.errors))
+        self.assertEquals([], test.check())
+
+    def test_violation(self):
+        loadtest.configure_store('memory')
+        test = loadtest.LoadTest(loadtest.InProcessClient('secret'), 2, 2, 'secret')
+        test.setup(1)
+        application.route('LOAD00001', ['register', 'X'], 'x', 'x', 'TLOAD')
+        application.route('LOAD00001', ['pool', 'reset'], 'x', 'x', 'TLOAD') # Deals 6 of each color
+        violations = test.check()
+        self.assertEquals(3, len(violations))
+        self.assertTrue(violations[0].startswith('LOAD00001: 3 players listed, 2 registered'))
+
+class EventLogTests(unittest.TestCase):
+    def setUp(self):
+        storage.configure({'STORAGE_BACKEND': 'memory', 'SNAPSHOT_INTERVAL': 3})
+        application.route('E1', ['register', 'Ann'], 'u1', 'ann')
+        application.route('E1', ['register', 'Bob'], 'u2', 'bob')
+        application.route('E1', 'setup add A bowling alley'.split(' '), 'u1', 'ann')
+        application.route('E1', ['pool', 'reset'], 'u1', 'ann')
+
+    def tearDown(self):
+        storage.configure({'SNAPSHOT_INTERVAL': storage.DEFAULTS['SNAPSHOT_INTERVAL']})
+
+    def document(self):
+        return unstamped(storage.get_backend().load('E1'))
+
+    def test_history(self):
+        application.route('E1', ['status'], 'u1', 'ann') # Changes nothing, so not logged
+        self.assertEquals('2) bob: register Bob\n3) ann: setup add A bowling alley\n4) ann: pool reset',
+                          application.route('E1', ['history', '3'], 'u1', 'ann')['text'])
+        for count in ('0', '-1', '101', 'lots'):
+            self.assertTrue(application.route('E1', ['history', count], 'u1', 'ann')['text'].startswith('Usage: /fiasco history'))
+
+    def test_undo_reset(self):
+        before = self.document()
+        application.route('E1', ['reset', 'confirm'], 'u2', 'bob')
+        self.assertEquals(None, self.document().get('users'))
+        response = application.route('E1', ['undo'], 'u1', 'ann')
+        self.assertEquals('ann undid "reset confirm" by bob', response['text'])
+        self.assertEquals(dict(before, _version=6), self.document())
+        application.route('E1', ['undo'], 'u1', 'ann')
+        self.assertEquals(['u1', 'u2'], sorted(self.document()['users']))
+        self.assertEquals(None, self.document().get('dice'))
+        self.assertTrue(application.route('E1', ['history'], 'u1', 'ann')['text'].endswith(
+            '4) ann: pool reset (undone)\n5) bob: reset confirm (undone)\n6) ann: undo\n7) ann: undo'))
+
+    def test_undo_setup(self):
+        setup = lambda: storage.get_backend().load('E1')['setup']
+        application.route('E1', 'setup add A stolen car'.split(' '), 'u1', 'ann')
+        application.route('E1', ['undo'], 'u1', 'ann')
+        self.assertEquals(['A bowling alley'], setup())
+        application.route('E1', ['setup', 'remove', '0'], 'u1', 'ann')
+        self.assertEquals([], setup())
+        application.route('E1', ['undo'], 'u1', 'ann')
+        self.assertEquals(['A bowling alley'], setup())
+
+    def test_undo_nothing(self):
+        for i in range(4):
+            application.route('E1', ['undo'], 'u1', 'ann')
+        self.assertEquals({'_id': 'E1', '_version': 8}, self.document())
+        self.assertEquals('Nothing to undo.', application.route('E1', ['undo'], 'u1', 'ann')['text'])
+
+    def test_rebuild(self):
+        application.route('E1', 'setup add A stolen van'.split(' '), 'u1', 'ann')
+        self.assertEquals(storage.get_backend().load('E1'), storage.rebuild(storage.get_backend(), 'E1'))
+        self.assertEquals(3, storage.get_backend().load_snapshot('E1')[0])
+        at_setup = storage.rebuild(storage.get_backend(), 'E1', 3)
+        self.assertEquals(['A bowling alley'], at_setup['setup'])
+        self.assertEquals(None, at_setup.get('dice'))
+
+class ConcurrencyTests(unittest.TestCase):
+    PLAYERS = 8
+
+    def setUp(self):
+        storage.configure({'STORAGE_BACKEND': 'memory'})
+        for i in range(self.PLAYERS):
+            application.route('C1', ['register', 'Player%d' % i], 'u%d' % i, 'player%d' % i)
+        application.route('C1', ['pool', 'reset'], 'u0', 'player0')
+
+    def all_dice(self):
+        game_state = GameState()
+        game_state.load('C1')
+        game = Game(game_state)
+        dice = [d.to_json() for d in game.dice]
+        for user_id in game.users:
+            dice.extend([d.to_json() for d in game.get_user_dice(user_id)])
+        return sorted((d['c'], d['n']) for d in dice)
+
+    def test_parallel_take_and_give(self):
+        before = self.all_dice()
+        self.assertEquals(self.PLAYERS * 4, len(before))
+        errors = []
+        def player(i):
+            try:
+                for turn in range(3):
+                    color, number = random.choice(before)
+                    application.route('C1', ['take', '%s%d' % (color[0], number)], 'u%d' % i, 'player%d' % i)
+                    to = random.choice(['pool'] + ['player%d' % n for n in range(self.PLAYERS)])
+                    color, number = random.choice(before)
+                    application.route('C1', ['give', '%s%d' % (color[0], number), to], 'u%d' % i, 'player%d' % i)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=player, args=(i % self.PLAYERS,)) for i in range(200)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals([], errors)
+        self.assertEquals(before, self.all_dice())
+
+class StubSlackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.posts.append((self.path, json.loads(body)))
+        self.send_response(200 if self.path != '/broken' else 500)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class DeferredResponderTests(unittest.TestCase):
+    def setUp(self):
+        storage.configure({'STORAGE_BACKEND': 'memory'})
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubSlackHandler)
+        self.server.posts = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_deliver(self):
+        responder = DeferredResponder(application.route, workers=1)
+        responder.submit(self.url + '/hook1', 'C1', ['register', 'Ann'], 'u1', 'ann')
+        responder.submit(self.url + '/broken', 'C1', ['status'], 'u1', 'ann')
+        responder.join()
+        self.assertEquals(('/hook1', {'text': 'ann is now registered as Ann', 'response_type': 'in_channel'}), self.server.posts[0])
+        stats = responder.stats()
+        self.assertEquals((0, 1, 1), (stats['queue_depth'], stats['delivered'], stats['failed']))
+        self.assertTrue(stats['latency_max'] > 0)
+
+    def test_handler_error(self):
+        def fail(*args):
+            raise ValueError('boom')
+        responder = DeferredResponder(fail)
+        responder.submit(self.url + '/hook2')
+        responder.join()
+        self.assertEquals([('/hook2', {'text': 'Whoops! Error.'})], self.server.posts)
+
+    def test_only_slack_urls(self):
+        submitted = []
+        application.app.config['DEFERRED_RESPONSES'] = True
+        application.responder.submit = lambda response_url, *args: submitted.append(response_url)
+        try:
+            client = application.app.test_client()
+            for response_url in (self.url + '/hook3', 'https://hooks.slack.com.example.com/x', None,
+                                 'https://hooks.slack.com/commands/T1/1/abc'):
+                data = {'text': 'status', 'channel_id': 'C1', 'user_id': 'u1', 'user_name': 'ann'}
+                if response_url:
+                    data['response_url'] = response_url
+                text = json.loads(client.post('/fiasco/', data=data).data)['text']
+                self.assertEquals(response_url == 'https://hooks.slack.com/commands/T1/1/abc', text == 'Working on it...')
+        finally:
+            del application.responder.submit
+            application.app.config.pop('DEFERRED_RESPONSES')
+        self.assertEquals(['https://hooks.slack.com/commands/T1/1/abc'], submitted)
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        storage.configure({'STORAGE_BACKEND': 'memory'})
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test', buckets=(0.1, 1))
+        histogram.observe(0.5, command='take')
+        histogram.observe(2, command='take')
+        self.assertEquals(['# HELP test_seconds Test', '# TYPE test_seconds histogram',
+                           'test_seconds_bucket{command="take",le="0.1"} 0',
+                           'test_seconds_bucket{command="take",le="1"} 1',
+                           'test_seconds_bucket{command="take",le="+Inf"} 2',
+                           'test_seconds_sum{command="take"} 2.5',
+                           'test_seconds_count{command="take"} 2'], histogram.render())
+
+    def test_route(self):
+        count = metrics.PHASE_SECONDS.count(command='register', phase='save')
+        errors = metrics.COMMAND_ERRORS.get(command='status')
+        application.route('M1', ['register', 'Ann'], 'u1', 'ann')
+        self.assertEquals(count + 1, metrics.PHASE_SECONDS.count(command='register', phase='save'))
+        original = application.COMMAND_MAPPINGS['status']
+        application.COMMAND_MAPPINGS['status'] = lambda *args: 1/0
+        try:
+            self.assertRaises(ZeroDivisionError, application.route, 'M1', ['status'], 'u1', 'ann')
+        finally:
+            application.COMMAND_MAPPINGS['status'] = original
+        self.assertEquals(errors + 1, metrics.COMMAND_ERRORS.get(command='status'))
+
+    def test_endpoint(self):
+        application.route('M1', ['register', 'Ann'], 'u1', 'ann')
+        response = application.app.test_client().get('/metrics')
+        self.assertEquals(200, response.status_code)
+        self.assertTrue('fislacko_command_seconds_count{command="register"}' in response.data)
+        self.assertTrue('fislacko_deferred_queue_depth 0' in response.data)
+
 if __name__ == '__main__':
     unittest.main()
 